@@ -0,0 +1,5 @@
+# Benchmarks of the import pipeline on synthetic surveys
+
+from .generators import SurveyShape, SHAPES, get_shape
+from .runner import BenchCase, BenchRunner, run_cases, SINKS, SINK_MEMORY, SINK_PG
+from .history import record, read_history, compare, stage_walls, run_key
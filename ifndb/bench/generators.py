@@ -0,0 +1,187 @@
+"""
+    Synthetic surveys for benchmarks
+
+    Data are generated in the shape of the csv exported by the survey platform (question keys prefixed by the survey name,
+    one column by option for multiple choice questions, lists of items as json), with the import profile and the target table
+    matching them. Data only depend on the shape, the number of rows and the seed.
+"""
+import json
+from typing import Dict, List, Tuple
+
+import numpy
+import pandas
+
+from ..common import get_table_name
+from ..db.struct import ColumnDef, TableStruct
+
+KEY_SEPARATOR = '|'
+
+# Time of the first generated row (2020-09-13)
+START_TIME = 1600000000
+
+class SurveyShape:
+    """
+        Questions of a synthetic survey
+        singles: number of single choice questions
+        mcgs: number of options of each multiple choice question
+        items: number of questions answered by a json list of items
+        opens: number of open text questions
+    """
+    def __init__(self, name: str, singles: int, mcgs: List[int], items: int, opens: int, choices: int=6):
+        self.name = name
+        self.singles = singles
+        self.mcgs = mcgs
+        self.items = items
+        self.opens = opens
+        self.choices = choices
+
+    def scaled(self, width: int)->'SurveyShape':
+        """
+            Same survey with width times more questions
+        """
+        return SurveyShape(self.name, self.singles * width, self.mcgs * width, self.items * width, self.opens * width, self.choices)
+
+    def questions(self)->Dict[str, List[str]]:
+        """
+            Question keys by kind of question, questions are numbered in the order of the kinds
+        """
+        kinds = [('single', self.singles), ('mcg', len(self.mcgs)), ('items', self.items), ('open', self.opens)]
+        questions = {}
+        number = 1
+        for kind, count in kinds:
+            questions[kind] = ['Q%d' % n for n in range(number, number + count)]
+            number += count
+        return questions
+
+    def profile(self)->Dict:
+        """
+            Import profile of the survey (profile file content)
+        """
+        questions = self.questions()
+        conf = {
+            'table': self.name,
+            'prepare': [
+                {'timeelapsed': True},
+                {'rename': {
+                    "%s\\." % self.name: "",
+                    "version": "survey_version",
+                    "submitted": "timestamp",
+                    "participantID": "global_id",
+                    "\\|mcg$": "_mcg",
+                    "\\|open$": "_open",
+                }},
+                {'unjson': {'columns': [{'glob': 'Q*_mcg'}], 'parser': 'items_keys'}},
+                {'mcg': questions['mcg']},
+                {'indicator': {"(Q\\d+)_open": "\\1_other"}},
+                {'boolean': {'columns': [{'re': '^Q\\d+_\\d+$'}], 'na_false': True}},
+                {'skip_if_null': {'columns': ['global_id']}},
+            ],
+            'mapping': {
+                'ID': None,
+                'engineVersion': None,
+                'language': None,
+            },
+        }
+        return {'_config': {'key_separator': KEY_SEPARATOR}, self.name: conf}
+
+    def target_columns(self)->List[Tuple[str, str]]:
+        """
+            Columns of the target table (name, db type)
+        """
+        questions = self.questions()
+        columns = [
+            ('id', 'integer'),
+            ('global_id', 'character varying'),
+            ('timestamp', 'timestamp with time zone'),
+            ('opened', 'timestamp with time zone'),
+            ('survey_version', 'text'),
+            ('timeelapsed', 'integer'),
+        ]
+        columns.extend((q, 'integer') for q in questions['single'])
+        for q, options in zip(questions['mcg'], self.mcgs):
+            columns.extend(('%s_%d' % (q, k), 'boolean') for k in range(options))
+        columns.extend(('%s_mcg' % q, 'text') for q in questions['items'])
+        for q in questions['open']:
+            columns.append(('%s_open' % q, 'text'))
+            columns.append(('%s_other' % q, 'boolean'))
+        return columns
+
+    def table_struct(self, schema: str='public')->TableStruct:
+        """
+            Structure of the target table, as fetched from the database
+        """
+        columns = self.target_columns()
+        defs = dict((name, ColumnDef(name, dbtype, 'NO' if name in ['id', 'global_id', 'timestamp'] else 'YES')) for name, dbtype in columns)
+        return TableStruct(get_table_name(self.name), schema, [name for name, _ in columns], defs)
+
+    def create_table_query(self, schema: str='public')->str:
+        cols = []
+        for name, dbtype in self.target_columns():
+            if name == 'id':
+                cols.append('"id" serial primary key')
+            else:
+                cols.append('"%s" %s%s' % (name, dbtype, ' not null' if name in ['global_id', 'timestamp'] else ''))
+        return "CREATE TABLE %s.%s (%s)" % (schema, get_table_name(self.name), ", ".join(cols))
+
+    def generate(self, rows: int, seed: int=0)->pandas.DataFrame:
+        """
+            Survey responses as exported (one row by response)
+        """
+        rng = numpy.random.default_rng(seed)
+        questions = self.questions()
+        prefix = self.name + '.'
+
+        # Participants answer several times, a few responses have no participant
+        participants = numpy.array(['%016x' % v for v in rng.integers(0, 2**63, max(rows // 3, 1))], dtype=object)
+        global_id = participants[rng.integers(0, len(participants), rows)]
+        global_id[rng.random(rows) < 0.01] = None
+
+        opened = START_TIME + numpy.arange(rows) * 60 + rng.integers(0, 60, rows)
+        data = {
+            'ID': numpy.arange(rows),
+            'participantID': global_id,
+            'version': 'v1',
+            'opened': opened,
+            'submitted': opened + rng.integers(30, 900, rows),
+            'engineVersion': '1.0',
+            'language': 'fr',
+        }
+        for q in questions['single']:
+            values = pandas.array(rng.integers(0, self.choices, rows), dtype='Int64')
+            values[rng.random(rows) < 0.1] = pandas.NA
+            data[prefix + q] = values
+        answers = numpy.array(['true', 'false', None], dtype=object)
+        for q, options in zip(questions['mcg'], self.mcgs):
+            for k in range(options):
+                data['%s%s%s%d' % (prefix, q, KEY_SEPARATOR, k)] = answers[rng.choice(3, rows, p=[0.2, 0.7, 0.1])]
+        for q in questions['items']:
+            data['%s%s%smcg' % (prefix, q, KEY_SEPARATOR)] = self.items_payloads(rng, rows)
+        texts = numpy.array([None, 'other', 'autre chose', 'je ne sais pas', 'voir\tcommentaire'], dtype=object)
+        for q in questions['open']:
+            data['%s%s%sopen' % (prefix, q, KEY_SEPARATOR)] = texts[rng.choice(len(texts), rows, p=[0.85, 0.05, 0.05, 0.03, 0.02])]
+        return pandas.DataFrame(data)
+
+    def items_payloads(self, rng: numpy.random.Generator, rows: int)->numpy.ndarray:
+        """
+            Json lists of items, drawn from a limited set of distinct lists (as answers are)
+        """
+        payloads = [None]
+        for _ in range(63):
+            keys = sorted(rng.choice(self.choices, rng.integers(1, self.choices + 1), replace=False))
+            payloads.append(json.dumps({'items': [{'key': str(k)} for k in keys]}))
+        payloads = numpy.array(payloads, dtype=object)
+        return payloads[rng.integers(0, len(payloads), rows)]
+
+    def __str__(self):
+        return "<%s:%d singles, %d mcg, %d items, %d open>" % (self.name, self.singles, len(self.mcgs), self.items, self.opens)
+
+SHAPES = {
+    'intake': SurveyShape('intake', singles=24, mcgs=[6, 8, 10, 12], items=1, opens=3),
+    'weekly': SurveyShape('weekly', singles=12, mcgs=[20, 8, 6], items=2, opens=2),
+    'vaccination': SurveyShape('vaccination', singles=8, mcgs=[6, 4], items=1, opens=1),
+}
+
+def get_shape(name: str, width: int=1)->SurveyShape:
+    if name not in SHAPES:
+        raise Exception("Unknown survey shape '%s' (one of %s)" % (name, ', '.join(SHAPES)))
+    return SHAPES[name].scaled(width)
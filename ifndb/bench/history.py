@@ -0,0 +1,86 @@
+"""
+    History of benchmark results
+
+    Each result is appended as a json line with the time and the git commit of the code, so runs of a case can be compared across commits.
+"""
+import json
+import os
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+def git_commit(path: Optional[str]=None)->Optional[Dict]:
+    """
+        Commit of the working copy (and if it has uncommitted changes), None if not in a git repository
+    """
+    if path is None:
+        path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'sha': sha, 'dirty': status.strip() != ''}
+
+def record(file: str, results: List[Dict], label: Optional[str]=None):
+    """
+        Append results to the history file
+    """
+    commit = git_commit()
+    now = datetime.now().isoformat(timespec='seconds')
+    with open(file, 'a') as f:
+        for result in results:
+            entry = dict(result, time=now, commit=commit, label=label)
+            f.write(json.dumps(entry) + "\n")
+
+def read_history(file: str)->List[Dict]:
+    if not os.path.exists(file):
+        return []
+    entries = []
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line != '':
+                entries.append(json.loads(line))
+    return entries
+
+def run_key(entry: Dict)->str:
+    """
+        Identify the code a result was measured with
+    """
+    commit = entry.get('commit')
+    if commit is None:
+        return 'unknown'
+    return commit['sha'][:10] + ('+' if commit['dirty'] else '')
+
+def compare(entries: List[Dict])->List[Dict]:
+    """
+        For each case (with the same options), the last result and the last result measured with another code
+        Returns list of dict with 'case', 'last', 'previous' (None if the case was not run with another code)
+    """
+    cases: Dict[str, List[Dict]] = {}
+    for entry in entries:
+        key = entry['case'] + ' ' + json.dumps(entry.get('opts', {}), sort_keys=True)
+        cases.setdefault(key, []).append(entry)
+    comparisons = []
+    for key, runs in cases.items():
+        last = runs[-1]
+        previous = None
+        for entry in reversed(runs[:-1]):
+            if run_key(entry) != run_key(last):
+                previous = entry
+                break
+        comparisons.append({'case': last['case'], 'opts': last.get('opts', {}), 'last': last, 'previous': previous})
+    return comparisons
+
+def stage_walls(entry: Dict)->Dict[str, float]:
+    """
+        Wall time of each stage, preprocessors are summed in one 'preprocess' stage
+    """
+    walls: Dict[str, float] = {}
+    for stage in entry.get('stages', []):
+        name = stage['stage']
+        if name.startswith('preprocess'):
+            name = 'preprocess'
+        walls[name] = walls.get(name, 0) + stage['wall']
+    return walls
@@ -0,0 +1,194 @@
+"""
+    Run of benchmark cases
+
+    A case imports a generated survey file with the stage profiler enabled, into one of the sinks:
+
+    - memory: rows are read, prepared, converted, encoded and loaded by the load mode of the import, payloads are only measured (no database needed)
+    - pg: full import (staging table and merge) and export of the survey, in a throwaway database whose tables are recreated by each case
+"""
+import os
+import shutil
+import tempfile
+import time
+from datetime import timezone
+from typing import Dict, List, Optional
+
+from ..config import settings
+from ..db import DbQuery, connection, schema_cache
+from ..db.utils import quote_id
+from ..exporter import ExportProfile, ExporterManager
+from ..importer import Importer, CSVDataSource, LOAD_COPY_BINARY, LOAD_PREPARED
+from ..importer.encoder import ValuesEncoder, TextCopyEncoder, BinaryCopyEncoder
+from ..importer.manager import ImportLoad, PreparedBatch, COPY_BATCH_SIZE
+from ..profiling import peak_rss
+from ..utils import write_yaml
+from .generators import SurveyShape, get_shape
+from .sink import MemoryCursor, MemoryCopy, MemoryBinaryCopy, MemoryBatch
+
+SINK_MEMORY = 'memory'
+SINK_PG = 'pg'
+
+SINKS = [SINK_MEMORY, SINK_PG]
+
+class BenchCase:
+    """
+        One benchmark: a survey shape with a number of rows and a width (columns multiplier), imported into a sink
+    """
+    def __init__(self, shape: str, rows: int, width: int=1, sink: str=SINK_MEMORY, seed: int=0):
+        self.shape = shape
+        self.rows = rows
+        self.width = width
+        self.sink = sink
+        self.seed = seed
+
+    def name(self)->str:
+        return "%s/%dx%d/%s" % (self.shape, self.rows, self.width, self.sink)
+
+    def to_dict(self)->Dict:
+        return {'shape': self.shape, 'rows': self.rows, 'width': self.width, 'sink': self.sink, 'seed': self.seed}
+
+class BenchRunner:
+    """
+        opts: importer options (load_mode, chunk_size, workers...)
+        work_dir: directory of generated files (a temporary directory removed at the end if not provided)
+        dsn: connection parameters of the throwaway database (pg sink)
+    """
+    def __init__(self, opts: Dict, work_dir: Optional[str]=None, dsn: Optional[Dict]=None):
+        self.opts = dict(opts)
+        self.temporary = work_dir is None
+        self.work_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix='ifndb-bench-')
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.dsn = dsn
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def prepare(self, case: BenchCase, shape: SurveyShape):
+        """
+            Generate the survey file and its profile (reused if already generated in the work directory)
+        """
+        base = os.path.join(self.work_dir, "%s_%d_%d_%d" % (case.shape, case.rows, case.width, case.seed))
+        csv_file = base + '.csv'
+        profile_file = base + '.yaml'
+        if not os.path.exists(csv_file):
+            print("Generating %s" % csv_file)
+            tmp = csv_file + '.tmp'
+            shape.generate(case.rows, case.seed).to_csv(tmp, index=False)
+            os.replace(tmp, csv_file)
+        write_yaml(profile_file, shape.profile())
+        return csv_file, profile_file
+
+    def run(self, case: BenchCase)->Dict:
+        """
+            Run a case and returns its result (total time, rows by second and measures of each stage)
+        """
+        shape = get_shape(case.shape, case.width)
+        csv_file, profile_file = self.prepare(case, shape)
+        opts = dict(self.opts, profile_stages=True, profile_output=None, profile_dump=None)
+        importer = Importer(self.work_dir, opts)
+        importer.load_profile(profile_file)
+        source = CSVDataSource(csv_file, 'submitted')
+        start = time.perf_counter()
+        if case.sink == SINK_PG:
+            self.run_pg(importer, shape, source)
+        else:
+            self.run_memory(importer, shape, source)
+        wall = time.perf_counter() - start
+        return {
+            'case': case.name(),
+            'params': case.to_dict(),
+            'opts': dict((k, v) for k, v in self.opts.items() if k != 'debug'),
+            'wall': round(wall, 6),
+            'rows_per_s': round(case.rows / wall, 1) if wall > 0 else None,
+            'peak_rss': peak_rss(),
+            'stages': importer.profiler.collect(),
+        }
+
+    def run_memory(self, importer: Importer, shape: SurveyShape, source: CSVDataSource):
+        """
+            Same stages as the import (with the configured load mode), payloads are built and measured instead of being sent
+        """
+        profiler = importer.profiler
+        tb_conf = importer.profile.get_table(shape.name)
+        target = shape.table_struct()
+        plan = importer.plan_import(tb_conf, target, source)
+        export = None
+        load = None
+        try:
+            for rows in importer.prepared_chunks(tb_conf, source, plan):
+                if export is None:
+                    export = importer.build_export(tb_conf, target, rows.columns, plan.excluded)
+                with profiler.stage('convert', len(rows)):
+                    importer.convert_rows(rows, export)
+                if load is None:
+                    with profiler.stage('check', len(rows)):
+                        importer.check_columns(target, rows, export)
+                    if importer.has_error:
+                        raise Exception("Generated data cannot be imported in %s" % target.qualified_table())
+                    load = self.memory_load(importer, target, export)
+                load.load(rows)
+            if load is not None:
+                load.close()
+        except BaseException:
+            if load is not None:
+                load.abort()
+            raise
+
+    def memory_load(self, importer: Importer, target, export)->ImportLoad:
+        cursor = MemoryCursor()
+        table = target.qualified_table() + '_import'
+        if importer.load_mode == LOAD_PREPARED:
+            execute_query = "EXECUTE bench (%s)" % ",".join(['%s'] * len(export))
+            batch, encoder = PreparedBatch(MemoryBatch(cursor), execute_query), ValuesEncoder()
+        else:
+            cols = [quote_id(column.target) for column in export]
+            if importer.load_mode == LOAD_COPY_BINARY:
+                types = [target[column.target].get_type() for column in export]
+                batch = MemoryBinaryCopy(cursor, table, cols, types, COPY_BATCH_SIZE, timezone.utc)
+                encoder = BinaryCopyEncoder(batch.encoders)
+            else:
+                batch, encoder = MemoryCopy(cursor, table, cols, COPY_BATCH_SIZE), TextCopyEncoder()
+        return ImportLoad(importer, None, target, table, export, cursor, batch, encoder)
+
+    def run_pg(self, importer: Importer, shape: SurveyShape, source: CSVDataSource):
+        """
+            Import into a newly created table, then export it into the export schema
+        """
+        if self.dsn is None:
+            raise Exception("pg sink needs the connection to a throwaway database ('bench_dsn' in settings or --dsn)")
+        settings['dsn'] = self.dsn
+        connection.connect()
+        table = shape.table_struct()
+        db = DbQuery()
+        db.execute("DROP TABLE IF EXISTS %s" % table.qualified_table())
+        db.execute(shape.create_table_query())
+        schema_cache.invalidate()
+        importer.import_table(shape.name, source)
+
+        profile = ExportProfile({shape.name: {'source': table.table_name, 'mapping': dict((c, None) for c in table.columns if c != 'id')}}, {})
+        export_table = profile.get_table(shape.name).get_target_table()
+        db.execute("CREATE SCHEMA IF NOT EXISTS %s" % export_table.schema)
+        db.execute("DROP TABLE IF EXISTS %s" % export_table)
+        db.execute(shape.create_table_query(export_table.schema))
+        schema_cache.invalidate()
+        result = ExporterManager(profile).build(shape.name)[shape.name]
+        if len(result.errors) > 0:
+            raise Exception("Export errors: %s" % '; '.join(result.errors))
+        with importer.profiler.stage('export', importer.profiler.get('merge').rows_in) as run:
+            run.rows_out = DbQuery().execute(result.update.query())
+
+def run_cases(runner: BenchRunner, cases: List[BenchCase], repeat: int=1)->List[Dict]:
+    """
+        Run each case repeat times, the fastest run of each case is kept
+    """
+    results = []
+    for case in cases:
+        best = None
+        for _ in range(repeat):
+            result = runner.run(case)
+            if best is None or result['wall'] < best['wall']:
+                best = result
+        best['repeat'] = repeat
+        results.append(best)
+    return results
@@ -0,0 +1,65 @@
+"""
+    Memory sink: batches building the payloads of the import as they would be sent, payloads are only measured
+"""
+from typing import List
+
+from psycopg2.extensions import adapt
+
+from ..db.copy import DbCopy, DbBinaryCopy
+from ..db.query import DbBatch
+
+def quote_value(value)->bytes:
+    adapted = adapt(value)
+    if hasattr(adapted, 'encoding'):
+        adapted.encoding = 'utf8'
+    return adapted.getquoted()
+
+class MemoryCursor:
+    """
+        Cursor without connection, queries are built as cursor.mogrify() does
+    """
+    def mogrify(self, query: str, values=None)->bytes:
+        query = query.encode('utf-8')
+        if values is None:
+            return query
+        return query % tuple(quote_value(v) for v in values)
+
+    def close(self):
+        pass
+
+class MeasuredCopy:
+    """
+        Replace the run of a COPY batch: the payload is built and measured
+    """
+    def run(self):
+        if len(self.chunks) == 0:
+            return
+        self.sent += self.payload().getbuffer().nbytes
+        self.index += len(self.chunks)
+        self.chunks = []
+
+class MemoryCopy(MeasuredCopy, DbCopy):
+    pass
+
+class MemoryBinaryCopy(MeasuredCopy, DbBinaryCopy):
+    pass
+
+class MemoryBatch(DbBatch):
+    """
+        Queries are grouped as for the database, payloads of the groups are measured
+    """
+    def __init__(self, cursor, batch_size=None):
+        super().__init__(cursor, batch_size)
+        self.adaptive = False # No round trip to adapt to
+
+    def run(self):
+        start = 0
+        while start < len(self.chunks):
+            end = self.group_end(start)
+            self.send(self.chunks[start:end])
+            start = end
+        self.chunks = []
+
+    def send(self, queries: List):
+        self.index += len(queries)
+        self.sent += len(self.payload(queries))
@@ -5,7 +5,7 @@ def register(klass):
     COMMANDS.append(klass)
 
 # Load module to be able to register (autoloader)
-from . import loader, launch, export, config
+from . import loader, launch, export, config, bench
 
 def get_commands():
     return COMMANDS
@@ -0,0 +1,128 @@
+from cliff.command import Command
+from rich.console import Console
+from rich.table import Table
+from . import register
+from ..config import settings
+from ..bench import BenchCase, BenchRunner, run_cases, SHAPES, SINKS, SINK_MEMORY, SINK_PG
+from ..bench import record, read_history, compare, stage_walls, run_key
+from ..importer import LOAD_MODES, LOAD_COPY, DEFAULT_SEND_QUEUE
+
+def parse_dsn(dsn):
+    if dsn is None:
+        return None
+    if isinstance(dsn, dict):
+        return dsn
+    return {'dsn': dsn}
+
+class BenchCommand(Command):
+    """
+    Benchmark the import of synthetic surveys, results are appended to a history file
+    """
+
+    name = 'bench'
+
+    def get_parser(self, prog_name):
+        parser = super(BenchCommand, self).get_parser(prog_name)
+        parser.add_argument("--shapes", help="Survey shapes to generate", nargs='+', choices=list(SHAPES), default=list(SHAPES))
+        parser.add_argument("--rows", help="Number of rows of the generated surveys", nargs='+', type=int, default=[100000])
+        parser.add_argument("--width", help="Multiply the number of questions of the surveys", nargs='+', type=int, default=[1])
+        parser.add_argument("--sink", help="memory: no database (payloads are only measured), pg: import and export in a throwaway database", choices=SINKS, nargs='+', default=[SINK_MEMORY])
+        parser.add_argument("--dsn", help="Connection string of the throwaway database (default 'bench_dsn' in settings)", default=None)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", help="Run each case N times, the fastest run is kept", type=int, default=1)
+        parser.add_argument("--load-mode", choices=LOAD_MODES, default=LOAD_COPY)
+        parser.add_argument("--chunk-size", type=int, default=0)
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--send-queue", type=int, default=DEFAULT_SEND_QUEUE)
+        parser.add_argument("--work-dir", help="Keep generated files in this directory (reused by the next runs)", default=None)
+        parser.add_argument("--history", help="History file (json lines, default 'bench_history' in settings or bench.jsonl)", default=None)
+        parser.add_argument("--label", help="Label of the run in the history", default=None)
+        parser.add_argument("--compare", help="Only compare the last results of each case with the previous commit", action="store_true", default=False)
+        return parser
+
+    def take_action(self, args):
+        history = args.history or settings.get('bench_history', 'bench.jsonl')
+        if args.compare:
+            self.show_comparison(read_history(history))
+            return
+
+        opts = {
+            'debug': self.app.options.debug,
+            'load_mode': args.load_mode,
+            'chunk_size': args.chunk_size,
+            'workers': args.workers,
+            'send_queue': args.send_queue,
+        }
+        dsn = parse_dsn(args.dsn or settings.get('bench_dsn'))
+        if SINK_PG in args.sink and dsn is None:
+            print("pg sink needs a throwaway database, define 'bench_dsn' in settings.json or use --dsn")
+            return
+
+        cases = []
+        for sink in args.sink:
+            for shape in args.shapes:
+                for rows in args.rows:
+                    for width in args.width:
+                        cases.append(BenchCase(shape, rows, width, sink, args.seed))
+
+        runner = BenchRunner(opts, args.work_dir, dsn)
+        try:
+            results = []
+            for case in cases:
+                print("Running %s" % case.name())
+                results.extend(run_cases(runner, [case], args.repeat))
+                record(history, results[-1:], args.label)
+        finally:
+            runner.close()
+        self.show_results(results)
+        print("Results appended to %s" % history)
+
+    def show_results(self, results):
+        stages = []
+        for result in results:
+            for name in stage_walls(result):
+                if name not in stages:
+                    stages.append(name)
+        table = Table(title="Benchmark")
+        table.add_column("Case", no_wrap=True)
+        table.add_column("Wall (s)")
+        table.add_column("Rows/s")
+        table.add_column("Peak RSS (MB)")
+        for name in stages:
+            table.add_column(name)
+        for result in results:
+            walls = stage_walls(result)
+            row = [result['case'], "%.3f" % result['wall'], "%.0f" % result['rows_per_s'], "%.1f" % (result['peak_rss'] / (1024 * 1024))]
+            row.extend("%.3f" % walls[name] if name in walls else '' for name in stages)
+            table.add_row(*row)
+        Console().print(table)
+
+    def show_comparison(self, entries):
+        table = Table(title="Benchmark comparison")
+        table.add_column("Case", no_wrap=True)
+        table.add_column("Options")
+        table.add_column("Previous")
+        table.add_column("Last")
+        table.add_column("Wall (s)")
+        table.add_column("Change")
+        table.add_column("Slowest stages")
+        for comparison in compare(entries):
+            last = comparison['last']
+            previous = comparison['previous']
+            opts = ','.join("%s=%s" % (k, v) for k, v in sorted(comparison['opts'].items()))
+            if previous is None:
+                table.add_row(comparison['case'], opts, '', run_key(last), "%.3f" % last['wall'], '', '')
+                continue
+            change = (last['wall'] - previous['wall']) / previous['wall'] * 100 if previous['wall'] > 0 else 0
+            walls = stage_walls(last)
+            before = stage_walls(previous)
+            changes = []
+            for name, wall in sorted(walls.items(), key=lambda x: -x[1])[:3]:
+                if name in before and before[name] > 0:
+                    changes.append("%s %+.0f%%" % (name, (wall - before[name]) / before[name] * 100))
+                else:
+                    changes.append(name)
+            table.add_row(comparison['case'], opts, run_key(previous), run_key(last), "%.3f -> %.3f" % (previous['wall'], last['wall']), "%+.1f%%" % change, ', '.join(changes))
+        Console().print(table)
+
+register(BenchCommand)
@@ -1,8 +1,9 @@
 from . import register
 from cliff.command import Command
 from ..config import settings
-from ..exporter import ExportProfile, ExporterManager, get_export_table
+from ..exporter import ExportProfile, ExporterManager, get_export_table, SurveyExport, run_exports, STATUS_DONE, ExportState
 from ..db import DbQuery
+from ..db.session import pool_config
 from ..common import TABLES
 from pathlib import Path
 from rich.console import Console
@@ -23,6 +24,10 @@ class ExportCommand(Command):
         g.add_argument("--select", help="Test select query", action="store_true", default=False)
         g.add_argument("--apply", help="apply query", action="store_true", default=False)
         g.add_argument("--show", help="Show query (default)", action="store_true", default=False)
+        parser.add_argument("--jobs", help="Number of surveys exported at the same time (each with its own connection)", type=int, default=1)
+        parser.add_argument("--incremental", help="Only replace the days changed since the last export", action="store_true", default=False)
+        parser.add_argument("--state", help="State file of incremental export (default is [profile].state.json next to the profile)", default=None)
+        parser.add_argument("--checksum", help="Incremental export also compares a checksum of the rows of each day", action="store_true", default=False)
         return parser
 
     def take_action(self, args):
@@ -54,36 +59,55 @@ class ExportCommand(Command):
         else:
             dry_run = False
         
+        state = None
+        if args.incremental:
+            state_file = args.state
+            if state_file is None:
+                state_file = str(Path(profile_path, profile_name + '.state.json'))
+            state = ExportState(state_file)
+        exports = []
         for name, res in results.items():
-            print("Export profile ", name)
-            update = res.update
-            src_range = update.source_range()
-            if args.select:
-                select_query = update.select()
-                print(select_query)
-                try:
-                    q = DbQuery()
-                    count = q.execute(select_query)
-                    print("%d rows" % (count))
-                except Exception as e:
-                    print("Error running select query")
-                    print(e)
-            if args.apply or args.show:
-                q = DbQuery()
-                try:
-                    cleanup_query = "DELETE FROM %s where timestamp >= %%s and timestamp <= %%s" % (update.target_table)
-                    if dry_run:
-                        print(cleanup_query.replace('%%s','%s') % (src_range[0], src_range[1]))
-                    else:
-                        q.execute(cleanup_query, (src_range[0], src_range[1]))
-                    update_query = update.query()
-                    if dry_run:
-                        print(update_query)
-                    else:
-                        q.execute(update_query)
-                except Exception as e:
-                    print("Error executing query")
-                    print(e)
+            fingerprint = profile.get_table(name).fingerprint()
+            exports.append(SurveyExport(name, res.update, state, fingerprint, args.checksum))
+        jobs = min(args.jobs, len(exports), pool_config()['size'])
+        if jobs < min(args.jobs, len(exports)):
+            print("Using %d jobs (size of the connection pool, see 'db_pool' in settings)" % jobs)
+
+        def show_export(export: SurveyExport):
+            print("Export profile ", export.name)
+            for line in export.output:
+                print(line)
+            if jobs > 1:
+                print("%s %s in %.2fs" % (export.name, export.status, export.duration))
+
+        run_exports(exports, jobs, args.select, args.apply, dry_run, show_export)
+        if jobs > 1 or args.apply:
+            self.show_summary(exports)
+
+    def show_summary(self, exports):
+        tb = Table(title="Export")
+        tb.add_column("Survey")
+        tb.add_column("Target")
+        tb.add_column("From")
+        tb.add_column("To")
+        tb.add_column("Selected")
+        tb.add_column("Deleted")
+        tb.add_column("Inserted")
+        tb.add_column("Refresh")
+        tb.add_column("Time (s)")
+        tb.add_column("Status")
+        def count(value):
+            return '' if value is None else str(value)
+        def refresh(export: SurveyExport):
+            if export.refresh is None:
+                return 'full'
+            return "%d days" % export.refresh
+        for export in exports:
+            src_range = export.range if export.range is not None else (None, None)
+            color = 'green' if export.status == STATUS_DONE else 'red'
+            status = "[%s]%s[/%s]" % (color, export.status, color)
+            tb.add_row(export.name, str(export.update.target_table), count(src_range[0]), count(src_range[1]), count(export.selected), count(export.deleted), count(export.inserted), refresh(export), "%.2f" % export.duration, status)
+        Console().print(tb)
 
 class ExportShowCommand(Command):
     """
@@ -2,7 +2,7 @@ import os
 import json
 from cliff.command import Command
 from . import register
-from ..db import DbQuery, connection
+from ..db import DbQuery, connection, schema_cache
 from ..sql import load_template
 
 class LaunchViewCommand(Command):
@@ -31,6 +31,7 @@ class LaunchViewCommand(Command):
             connection.connect()
             q = DbQuery()
             q.execute(query)
+            schema_cache.invalidate()
             print("Launch view applied")
         else:
             print(query)
@@ -4,8 +4,14 @@ from cliff.command import Command
 from . import register
 from ..utils import from_iso_time,write_content,read_json
 from ..db import DbQuery, connection
-from ..importer import Importer, CSVDataSource, Profile
+from ..importer import Importer, CSVDataSource, Profile, LOAD_MODES, LOAD_COPY, DEFAULT_SEND_QUEUE
+from ..importer.parallel import init_worker, stage_file
+from ..importer.delta import ImportState
+from typing import Optional
+from ..config import settings
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import random
 import string
 
@@ -29,6 +35,17 @@ class ImportCommand(Command):
         parser.add_argument("--dry-run", action="store_true")
         parser.add_argument("--show-batch", type=int, default=0)
         parser.add_argument("--show-batch-row", type=int, default=0)
+        parser.add_argument("--load-mode", help="How rows are loaded into the staging table", choices=LOAD_MODES, default=LOAD_COPY)
+        parser.add_argument("--chunk-size", help="Stream the csv file by chunks of N rows (0 = load the whole file)", type=int, default=0)
+        parser.add_argument("--cache", help="Directory of the cache of prepared data (default from 'import_cache' in settings)", default=None)
+        parser.add_argument("--cache-size", help="Maximum size of the cache in MB", type=int, default=2048)
+        parser.add_argument("--bulk-ids", help="Reserve ids of imported rows in one sequence call", action="store_true", default=False)
+        parser.add_argument("--workers", help="Number of threads preparing and converting columns in parallel", type=int, default=1)
+        parser.add_argument("--send-queue", help="Encoded slices of rows waiting to be sent while next rows are encoded (0 = no sending thread)", type=int, default=DEFAULT_SEND_QUEUE)
+        parser.add_argument("--skip-unknown-columns", help="Do not load columns absent from the target table (error otherwise)", action="store_true", default=False)
+        parser.add_argument("--profile-stages", help="Show time, rows and memory used by each stage of the import", action="store_true", default=False)
+        parser.add_argument("--profile-output", help="Append stages measures to this file (json lines)", default=None)
+        parser.add_argument("--profile-dump", help="Run stages starting with this name under cProfile (stats saved in [name].prof)", default=None)
         
         return parser
 
@@ -44,6 +61,17 @@ class ImportCommand(Command):
             'dry_run': args.dry_run,
             'show_batch': args.show_batch,
             'show_batch_row': args.show_batch_row,
+            'load_mode': args.load_mode,
+            'chunk_size': args.chunk_size,
+            'cache_path': args.cache or settings.get('import_cache'),
+            'cache_size': args.cache_size * 1024 * 1024,
+            'bulk_ids': args.bulk_ids,
+            'skip_unknown_columns': args.skip_unknown_columns,
+            'workers': args.workers,
+            'send_queue': args.send_queue,
+            'profile_stages': args.profile_stages,
+            'profile_output': args.profile_output,
+            'profile_dump': args.profile_dump,
         }
 
         source = CSVDataSource(file, 'submitted')
@@ -51,6 +79,7 @@ class ImportCommand(Command):
         importer = Importer(path, opts)
         importer.load_profile(args.profile)
         importer.import_table(args.table, source)
+        importer.profiler.report(file)
 
 class ImportCatalogCommand(Command):
     """
@@ -65,10 +94,28 @@ class ImportCatalogCommand(Command):
         parser.add_argument("--table", help="Table name (entry name in profile)", required=True)
         parser.add_argument("--catalog", help="csv of catalog files", required=True)
         parser.add_argument("--dry-run", action="store_true") 
+        parser.add_argument("--jobs", help="Number of files loaded in parallel (each by a worker process)", type=int, default=1)
+        parser.add_argument("--incremental", help="Only load new or changed rows of each file", action="store_true", default=False)
+        parser.add_argument("--state", help="State file of incremental import (default is [catalog].[table].state.json)", default=None)
+        parser.add_argument("--load-mode", help="How rows are loaded into the staging table", choices=LOAD_MODES, default=LOAD_COPY)
+        parser.add_argument("--chunk-size", help="Stream the csv file by chunks of N rows (0 = load the whole file)", type=int, default=0)
+        parser.add_argument("--cache", help="Directory of the cache of prepared data (default from 'import_cache' in settings)", default=None)
+        parser.add_argument("--cache-size", help="Maximum size of the cache in MB", type=int, default=2048)
+        parser.add_argument("--bulk-ids", help="Reserve ids of imported rows in one sequence call", action="store_true", default=False)
+        parser.add_argument("--workers", help="Number of threads preparing and converting columns in parallel", type=int, default=1)
+        parser.add_argument("--send-queue", help="Encoded slices of rows waiting to be sent while next rows are encoded (0 = no sending thread)", type=int, default=DEFAULT_SEND_QUEUE)
+        parser.add_argument("--skip-unknown-columns", help="Do not load columns absent from the target table (error otherwise)", action="store_true", default=False)
+        parser.add_argument("--profile-stages", help="Show time, rows and memory used by each stage of the import", action="store_true", default=False)
+        parser.add_argument("--profile-output", help="Append stages measures to this file (json lines)", default=None)
+        parser.add_argument("--profile-dump", help="Run stages starting with this name under cProfile (stats saved in [name].prof)", default=None)
         return parser
 
     def take_action(self, args):
 
+        if args.incremental and args.chunk_size > 0:
+            print("--incremental cannot be used with --chunk-size (rows sharing a key must be compared at once)")
+            return
+
         catalog_file = args.catalog
         path = os.path.dirname(catalog_file)
 
@@ -77,6 +124,17 @@ class ImportCatalogCommand(Command):
         opts = {
             'debug': debug,
             'dry_run': args.dry_run,
+            'load_mode': args.load_mode,
+            'chunk_size': args.chunk_size,
+            'cache_path': args.cache or settings.get('import_cache'),
+            'cache_size': args.cache_size * 1024 * 1024,
+            'bulk_ids': args.bulk_ids,
+            'skip_unknown_columns': args.skip_unknown_columns,
+            'workers': args.workers,
+            'send_queue': args.send_queue,
+            'profile_stages': args.profile_stages,
+            'profile_output': args.profile_output,
+            'profile_dump': args.profile_dump,
         }
         
         data_path = os.path.dirname(catalog_file)
@@ -87,6 +145,7 @@ class ImportCatalogCommand(Command):
 
         counter = Counter()
         
+        entries = []
         for catalog_entry in catalog['files']:
             file = data_path + '/' + catalog_entry['file']
             mark_file = file + mark_ext
@@ -100,16 +159,91 @@ class ImportCatalogCommand(Command):
                     continue
             min_time = from_iso_time(catalog_entry['start'])
             max_time = from_iso_time(catalog_entry['end'])
-            print("Processing %s [%s, %s]" % (file, min_time, max_time))
-            source = CSVDataSource(file, 'submitted')
-            source.set_time_range(min_time, max_time)
-            importer = Importer(path, opts)
-            importer.load_profile(args.profile)
-            importer.import_table(args.table, source)
-            write_content(mark_file, '') # Mark file as done
-            counter['processed'] += 1
+            entries.append((file, min_time, max_time))
+
+        importer = Importer(path, opts)
+        importer.load_profile(args.profile)
+
+        state = None
+        if args.incremental:
+            state_file = args.state
+            if state_file is None:
+                state_file = "%s.%s.state.json" % (os.path.splitext(catalog_file)[0], args.table)
+            state = ImportState(state_file, importer.profile.get_table(args.table).fingerprint())
+
+        if args.jobs > 1:
+            self.run_parallel(args, importer, entries, opts, counter, state)
+        else:
+            for file, min_time, max_time in entries:
+                print("Processing %s [%s, %s]" % (file, min_time, max_time))
+                source = CSVDataSource(file, 'submitted')
+                source.set_time_range(min_time, max_time)
+                delta = state.delta(min_time, max_time) if state is not None else None
+                staged = importer.stage_table(args.table, source, delta=delta)
+                if staged is not None:
+                    importer.merge_staged(staged)
+                    # Rows of a dry run are not in the target table
+                    if state is not None and not importer.dry_run:
+                        state.update(delta)
+                importer.profiler.report(file)
+                write_content(file + mark_ext, '') # Mark file as done
+                counter['processed'] += 1
         print("%d processed, %d skipped (already done)" % (counter['processed'], counter['skipped']))
 
+    def run_parallel(self, args, importer: Importer, entries, opts, counter: Counter, state: Optional[ImportState]):
+        """
+            Files are loaded into distinct staging tables by a pool of processes (each with its own connection)
+            The merge into the target table is done here, one file at a time and in the catalog order
+            Workers are spawned (not forked) so they never share the connection of this process
+            Stages measures of workers are reported here with the merge of each file (cProfile dump is not available)
+        """
+        path = os.path.dirname(args.catalog)
+        initargs = (dict(settings), path, dict(opts, profile_dump=None), args.profile)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context, initializer=init_worker, initargs=initargs) as pool:
+            futures = []
+            for index, entry in enumerate(entries):
+                file, min_time, max_time = entry
+                print("Processing %s [%s, %s]" % (file, min_time, max_time))
+                delta = state.delta(min_time, max_time) if state is not None else None
+                future = pool.submit(stage_file, args.table, file, min_time, max_time, '_%d' % index, delta)
+                futures.append((file, future))
+            for index, (file, future) in enumerate(futures):
+                try:
+                    staged, stages = future.result()
+                    importer.profiler.merge(stages)
+                    if staged is not None:
+                        print("Merging %s (%d rows)" % (file, staged.count))
+                        importer.merge_staged(staged, drop_staging=True)
+                        if state is not None and not importer.dry_run:
+                            state.update(staged.delta)
+                except BaseException:
+                    self.drop_unmerged(importer, futures[index:])
+                    raise
+                importer.profiler.report(file)
+                write_content(file + '.done', '') # Mark file as done
+                counter['processed'] += 1
+
+    def drop_unmerged(self, importer: Importer, futures):
+        """
+            Drop the staging tables of the files not merged after a failure
+            Files not started are cancelled, a failed worker leaves no staging table (rolled back)
+        """
+        for file, future in futures:
+            future.cancel()
+        for file, future in futures:
+            try:
+                staged, stages = future.result()
+            except Exception:
+                continue
+            if staged is None:
+                continue
+            try:
+                importer.drop_staged(staged)
+                print("Dropped staging table %s of %s" % (staged.temp_table, file))
+            except Exception as e:
+                print("Unable to drop staging table %s of %s : %s" % (staged.temp_table, file, e))
+
 
 class QuerySet:
 
@@ -5,4 +5,5 @@
 from .query import get_cursor, DbQuery, connection
 from .utils import *
 from .types import *
-from .struct import get_table_struct, TableStruct, TableStructDiff, UnknownTableException
\ No newline at end of file
+from .struct import get_table_struct, prefetch_table_structs, schema_cache, TableStruct, TableStructDiff, UnknownTableException
+from .copy import DbCopy, DbBinaryCopy, DbFakeCopy, COPY_TEXT, COPY_BINARY
@@ -0,0 +1,207 @@
+"""
+ Bulk loading using COPY ... FROM STDIN
+"""
+import io
+import struct
+from datetime import datetime, date, timezone
+from typing import List
+
+import psycopg2
+
+from .query import connection, DbError
+from .types import normalize_db_type
+
+COPY_TEXT = 'text'
+COPY_BINARY = 'binary'
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+PG_EPOCH_NAIVE = datetime(2000, 1, 1)
+PG_EPOCH_DATE = date(2000, 1, 1)
+
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_TRAILER = struct.pack('!h', -1)
+
+TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+def copy_text_value(value)->str:
+    """
+        Encode a python value as a field of the COPY text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value).translate(TEXT_ESCAPES)
+
+def is_timestamptz(ntype: str)->bool:
+    return ntype in ['timestamp with time zone', 'timestamptz']
+
+def pack_micros(delta)->bytes:
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return struct.pack('!q', micros)
+
+class BinaryEncoder:
+    """
+        Encode values of a column to the COPY binary format, according to the db type of the target column
+    """
+
+    def __init__(self, dbtype:str, tz=None):
+        self.dbtype = dbtype
+        self.tz = tz
+        ntype = normalize_db_type(dbtype)
+        if ntype == 'smallint':
+            self.func = lambda v: struct.pack('!h', int(v))
+        elif ntype == 'int':
+            self.func = lambda v: struct.pack('!i', int(v))
+        elif ntype == 'bigint':
+            self.func = lambda v: struct.pack('!q', int(v))
+        elif ntype == 'bool':
+            self.func = lambda v: b'\x01' if v else b'\x00'
+        elif ntype in ['text', 'varying', 'character']:
+            self.func = lambda v: str(v).encode('utf-8')
+        elif ntype == 'double precision':
+            self.func = lambda v: struct.pack('!d', float(v))
+        elif ntype == 'real':
+            self.func = lambda v: struct.pack('!f', float(v))
+        elif ntype == 'date':
+            self.func = self.encode_date
+        elif is_timestamptz(ntype):
+            self.func = self.encode_timestamptz
+        elif ntype.startswith('timestamp'):
+            self.func = self.encode_timestamp
+        else:
+            raise DbError("Type '%s' is not handled by binary copy, use text copy" % (dbtype, ))
+
+    def encode_date(self, v):
+        if isinstance(v, datetime):
+            v = v.date()
+        return struct.pack('!i', (v - PG_EPOCH_DATE).days)
+
+    def encode_timestamptz(self, v):
+        if v.tzinfo is None:
+            # Naive timestamps are interpreted in the session time zone, as the text format does
+            v = v.replace(tzinfo=self.tz)
+        return pack_micros(v - PG_EPOCH)
+
+    def encode_timestamp(self, v):
+        # Time zone is ignored, as the text format does for timestamp without time zone
+        return pack_micros(v.replace(tzinfo=None) - PG_EPOCH_NAIVE)
+
+    def encode(self, value)->bytes:
+        if value is None:
+            return struct.pack('!i', -1)
+        data = self.func(value)
+        return struct.pack('!i', len(data)) + data
+
+def get_session_timezone(cursor):
+    """
+        Time zone of the current session (used to interpret naive timestamps)
+    """
+    from zoneinfo import ZoneInfo
+    cursor.execute("SHOW TimeZone")
+    name = cursor.fetchone()[0]
+    try:
+        return ZoneInfo(name)
+    except Exception as e:
+        raise DbError("Session time zone '%s' is not handled by binary copy, use text copy" % (name, )) from e
+
+class DbCopy:
+    """
+        Accumulate rows and send them to a table using COPY FROM STDIN (text format)
+    """
+
+    format = COPY_TEXT
+
+    def __init__(self, cursor, table:str, columns: List[str], batch_size: int):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.chunks = []
+        self.index = 0 # Number of rows sent
+        self.sent = 0 # Bytes sent
+
+    def copy_query(self):
+        return "COPY %s (%s) FROM STDIN WITH (FORMAT %s)" % (self.table, ",".join(self.columns), self.format)
+
+    def encode_row(self, values)->str:
+        return "\t".join(map(copy_text_value, values)) + "\n"
+
+    def show(self, payload)->str:
+        return payload
+
+    def append(self, values):
+        self.chunks.append(self.encode_row(values))
+        if len(self.chunks) >= self.batch_size:
+            self.run()
+
+    def extend(self, payloads: list):
+        """
+            Add already encoded rows
+        """
+        start = 0
+        while start < len(payloads):
+            end = start + self.batch_size - len(self.chunks)
+            self.chunks.extend(payloads[start:end])
+            start = end
+            if len(self.chunks) >= self.batch_size:
+                self.run()
+
+    def payload(self):
+        return io.BytesIO("".join(self.chunks).encode('utf-8'))
+
+    def run(self):
+        if len(self.chunks) == 0:
+            return
+        buf = self.payload()
+        size = buf.getbuffer().nbytes
+        try:
+            self.cursor.copy_expert(self.copy_query(), buf)
+            connection.commit()
+        except psycopg2.Error as e:
+            context = getattr(e.diag, 'context', None)
+            raise DbError("Copy error in batch starting at row %d (%s) : %s" % (self.index, context, e)) from e
+        self.index += len(self.chunks)
+        self.sent += size
+        self.chunks = []
+
+class DbBinaryCopy(DbCopy):
+    """
+        COPY FROM STDIN using the binary format, values are encoded according to the db types of the target columns
+    """
+
+    format = COPY_BINARY
+
+    def __init__(self, cursor, table:str, columns: List[str], types: List[str], batch_size: int, tz=None):
+        super().__init__(cursor, table, columns, batch_size)
+        if tz is None and any(is_timestamptz(normalize_db_type(t)) for t in types):
+            tz = get_session_timezone(cursor)
+        self.encoders = [BinaryEncoder(t, tz) for t in types]
+        self.field_count = struct.pack('!h', len(columns))
+
+    def encode_row(self, values)->bytes:
+        return self.field_count + b"".join(e.encode(v) for e, v in zip(self.encoders, values))
+
+    def show(self, payload)->str:
+        return repr(payload)
+
+    def payload(self):
+        return io.BytesIO(BINARY_HEADER + b"".join(self.chunks) + BINARY_TRAILER)
+
+class DbFakeCopy(DbCopy):
+
+    def run(self):
+        if len(self.chunks) == 0:
+            return
+        print("[fake] Copy batch of %d rows to %s" % (len(self.chunks), self.table))
+        self.index += len(self.chunks)
+        self.chunks = []
@@ -1,31 +1,117 @@
 
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
 import psycopg2
 from ..config import settings
+from .session import ConnectionPool, Session, pool_config
 
 class Connection:
+    """
+        Connection of the current thread to the database (settings['dsn'])
+        Each thread has its own session, connections come from a pool shared by the threads of the process
+    """
 
     def __init__(self) -> None:
-        self.conn = None
+        self.pool: Optional[ConnectionPool] = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
 
-    def connect(self):
+    def get_pool(self)->ConnectionPool:
         dsn = settings['dsn']
-        self.conn = psycopg2.connect(**dsn)
-        print(get_connexion_name())
+        with self.lock:
+            # A forked process or a new dsn needs its own connections
+            if self.pool is None or self.pool.pid != os.getpid() or self.pool.dsn != dsn:
+                if self.pool is not None and self.pool.pid == os.getpid():
+                    self.pool.close()
+                self.pool = ConnectionPool(dsn, **pool_config())
+            return self.pool
+
+    @property
+    def session(self)->Optional[Session]:
+        """
+            Session of the current thread, a session opened before a fork or with another dsn is dropped
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            return None
+        if session.pool.pid != os.getpid():
+            # Connection belongs to the parent process, the child must not use nor close it
+            self.local.session = None
+            return None
+        if session.pool.dsn != settings['dsn']:
+            session.close(discard=True)
+            self.local.session = None
+            return None
+        return session
+
+    @property
+    def conn(self):
+        session = self.session
+        return session.conn if session is not None else None
+
+    def connect(self, verbose: bool=True)->Session:
+        """
+            Session of the current thread, the connection is opened once and reused by the next calls
+            verbose: show the name of a new connection
+        """
+        session = self.session
+        if session is not None and session.is_alive():
+            session.recover()
+            return session
+        if session is not None:
+            session.close()
+        session = Session(self.get_pool())
+        self.local.session = session
+        if verbose:
+            print(get_connexion_name())
+        return session
 
     def cursor(self):
-        if self.conn is None:
-            self.connect()
-        return self.conn.cursor()
+        return self.connect().cursor()
 
     def commit(self):
-        if self.conn is None:
+        if self.session is None:
             raise Exception("Not connected")
-        self.conn.commit()
+        self.session.commit()
 
     def rollback(self):
-        if self.conn is None:
+        if self.session is None:
             raise Exception("Not connected")
-        self.conn.rollback()
+        self.session.rollback()
+
+    def transaction(self):
+        """
+            Transaction scope of the current thread (see Session.transaction)
+        """
+        return self.connect().transaction()
+
+    def prepare(self, query: str)->str:
+        return self.connect().prepare(query)
+
+    @contextmanager
+    def attach(self, session: Optional[Session]):
+        """
+            Use the session of another thread in the current thread (threads must not use it at the same time)
+        """
+        previous = getattr(self.local, 'session', None)
+        self.local.session = session
+        try:
+            yield session
+        finally:
+            self.local.session = previous
+
+    def close(self):
+        """
+            Give back the connection of the current thread to the pool
+        """
+        session = self.session
+        if session is not None:
+            session.close()
+            self.local.session = None
 
 
 connection = Connection()
@@ -56,12 +142,15 @@ class DbQuery:
         return self.execute(query)
 
     def execute(self, query, params=None, do_commit=True):
+        """
+            Execute a query and returns the number of rows affected
+            do_commit: commit after the query, if False the query is part of the current transaction
+        """
         cursor = get_cursor()
         cursor.execute(query, params)
-        count = True
         if do_commit:
             connection.commit()
-            count = cursor.rowcount
+        count = cursor.rowcount
         cursor.close()
         return count
 
@@ -88,34 +177,105 @@ class DbFakeQuery(DbQuery):
         return True
 
 class DbBatch:
+    """
+        Send queries by groups, each group is sent as one multi-statement payload (one round trip)
+
+        The number of queries by group adapts to the measured round trip time (target_time) and to the size of the queries (max_payload).
+        Each group is protected by a savepoint: if a group fails, its queries are replayed one by one to find the failing query.
+        batch_size: fixed number of queries by group (adaptive if None)
+    """
+
+    # Round trip time aimed for a group
+    target_time = 0.25
 
-    def __init__(self, cursor, batch_size: int):
+    # Maximum size of a payload in bytes
+    max_payload = 4 * 1024 * 1024
+
+    min_group = 10
+    max_group = 20000
+
+    def __init__(self, cursor, batch_size: Optional[int]=None):
         self.cursor = cursor
         self.chunks = []
         self.batch_size = batch_size
-        self.index = 0
+        self.adaptive = batch_size is None
+        self.group = batch_size if batch_size is not None else 100 # Queries by round trip
+        self.index = 0 # Number of queries sent
+        self.sent = 0 # Bytes sent
 
     def append(self, query):
         self.chunks.append(query)
-        if len(self.chunks) > self.batch_size:
+        if len(self.chunks) >= self.group:
             self.run()
 
     def run(self):
-        q = None
+        start = 0
+        while start < len(self.chunks):
+            end = self.group_end(start)
+            self.send(self.chunks[start:end])
+            start = end
+        connection.commit()
+        self.chunks = []
+
+    def group_end(self, start: int)->int:
+        """
+            End of the group starting at start, within the group size and the payload limit
+        """
+        end = min(start + self.group, len(self.chunks))
+        size = 0
+        for index in range(start, end):
+            size += len(self.chunks[index])
+            if size > self.max_payload and index > start:
+                return index
+        return end
+
+    def payload(self, queries: list):
+        """
+            Queries of a group in one payload, queries are bytes when built by cursor.mogrify()
+        """
+        if len(queries) > 0 and isinstance(queries[0], bytes):
+            return b"SAVEPOINT ifndb_batch;\n" + b";\n".join(queries) + b";\nRELEASE SAVEPOINT ifndb_batch"
+        return "SAVEPOINT ifndb_batch;\n" + ";\n".join(queries) + ";\nRELEASE SAVEPOINT ifndb_batch"
+
+    def send(self, queries: list):
+        payload = self.payload(queries)
+        started = time.perf_counter()
         try:
-            for q in self.chunks:
-                self.index += 1
-                self.cursor.execute(q)
-            connection.commit()
+            self.cursor.execute(payload)
         except psycopg2.Error as e:
-            d = {}
-            for v in ['column_name', 'constraint_name', 'context', 'internal_query', 'datatype_name', 'internal_position','message_detail','message_hint','statement_position']:
-                if hasattr(e.diag, v):
-                    x = getattr(e.diag, v)
-                    if x is not None:
-                        d[v] = x 
-            raise DbError("Query error for query %d <<%s>> : %s" % (self.index,q, e)) from e
-        self.chunks = []
+            try:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT ifndb_batch")
+            except psycopg2.Error:
+                raise DbError("Query error for queries %d to %d : %s" % (self.index + 1, self.index + len(queries), e)) from e
+            self.replay(queries, e)
+        else:
+            self.adapt(len(queries), len(payload), time.perf_counter() - started)
+        self.index += len(queries)
+        self.sent += len(payload)
+
+    def replay(self, queries: list, error: psycopg2.Error):
+        """
+            Run queries of a failed group one by one, to report the failing query
+        """
+        for position, q in enumerate(queries):
+            try:
+                self.cursor.execute(q)
+            except psycopg2.Error as e:
+                raise DbError("Query error for query %d <<%s>> : %s" % (self.index + position + 1, q, e)) from e
+        print("[batch] Group of %d queries failed (%s) but succeeded when replayed" % (len(queries), error))
+
+    def adapt(self, count: int, size: int, elapsed: float):
+        """
+            Number of queries of the next groups, so a round trip takes about target_time (at most doubled at each step)
+        """
+        if not self.adaptive or count < self.group:
+            return
+        if elapsed > 0:
+            group = int(count * self.target_time / elapsed)
+        else:
+            group = self.group * 2
+        group = min(group, self.group * 2, self.max_group, max(1, int(self.max_payload * count / size)))
+        self.group = max(group, self.min_group)
 
 class DbFakeBatch(DbBatch):
 
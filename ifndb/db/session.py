@@ -0,0 +1,204 @@
+"""
+    Database sessions
+
+    Connections are taken from a bounded pool (one pool by process, created from settings['dsn']), each thread uses its own
+    session so parallel workers never share a connection. A session keeps its connection until it is closed: connecting
+    again reuses it, so commands handling several files connect only once.
+
+    Pool is configured by the 'db_pool' entry in settings:
+        'size': maximum number of connections of the process (default 4)
+        'check_after': idle time (seconds) after which a connection is checked before being reused (default 30)
+        'timeout': time to wait for a free connection (seconds, default 60)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import psycopg2
+from psycopg2 import extensions
+
+from ..config import settings
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CHECK_AFTER = 30
+DEFAULT_TIMEOUT = 60
+
+class PoolError(psycopg2.Error):
+    pass
+
+class ConnectionPool:
+    """
+        Bounded pool of connections, callers wait for a free connection when all are used
+        Connections are opened when needed and kept open once released, idle connections are checked before being reused
+        and broken connections are replaced
+    """
+    def __init__(self, dsn: Dict, size: int=DEFAULT_POOL_SIZE, check_after: float=DEFAULT_CHECK_AFTER, timeout: float=DEFAULT_TIMEOUT):
+        self.dsn = dict(dsn)
+        self.size = size
+        self.check_after = check_after
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.idle: List = []
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+        self.released: Dict[int, float] = {} # Last release time of connections
+        self.statements: Dict[int, Dict[str, str]] = {} # Prepared statements of connections (query => name)
+
+    def acquire(self):
+        if not self.available.acquire(timeout=self.timeout):
+            raise PoolError("No free connection after %gs (pool size is %d)" % (self.timeout, self.size))
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if len(self.idle) > 0 else None
+                if conn is None:
+                    return psycopg2.connect(**self.dsn)
+                if self.is_healthy(conn):
+                    return conn
+                self.discard(conn)
+        except Exception:
+            self.available.release()
+            raise
+
+    def is_healthy(self, conn)->bool:
+        if conn.closed:
+            return False
+        released = self.released.get(id(conn))
+        if released is None or time.time() - released < self.check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def discard(self, conn):
+        self.released.pop(id(conn), None)
+        self.statements.pop(id(conn), None)
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def release(self, conn, close: bool=False):
+        """
+            Give back a connection, an uncommitted transaction is rolled back
+        """
+        try:
+            if not conn.closed and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        try:
+            if close or conn.closed:
+                self.discard(conn)
+            else:
+                self.released[id(conn)] = time.time()
+                with self.lock:
+                    self.idle.append(conn)
+        finally:
+            self.available.release()
+
+    def prepared(self, conn)->Dict[str, str]:
+        return self.statements.setdefault(id(conn), {})
+
+    def close(self):
+        """
+            Close the idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+class Session:
+    """
+        Connection used by a thread, with its transaction scope and its prepared statements
+    """
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.conn = pool.acquire()
+        self.depth = 0 # Depth of transaction scopes
+
+    def is_alive(self)->bool:
+        return self.conn is not None and not self.conn.closed
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def commit(self):
+        """
+            Commit, unless in a transaction scope (commit is done at the end of the scope)
+        """
+        if self.depth == 0:
+            self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def recover(self):
+        """
+            Rollback a failed transaction left by a previous use of the session
+        """
+        if self.depth == 0 and self.conn.info.transaction_status == extensions.TRANSACTION_STATUS_INERROR:
+            self.conn.rollback()
+
+    @contextmanager
+    def transaction(self):
+        """
+            Queries of the scope are committed at its end (rolled back if an exception is raised)
+            Commits asked in the scope are deferred, nested scopes are part of the outer one
+        """
+        if self.depth > 0:
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+            return
+        self.depth = 1
+        try:
+            yield self
+        except BaseException:
+            self.depth = 0
+            self.conn.rollback()
+            raise
+        self.depth = 0
+        self.conn.commit()
+
+    def prepare(self, query: str)->str:
+        """
+            Name of a server side prepared statement of the query, prepared once by connection
+        """
+        statements = self.pool.prepared(self.conn)
+        name = statements.get(query)
+        if name is None:
+            name = 'ifndb_stmt_%d' % len(statements)
+            cursor = self.conn.cursor()
+            cursor.execute("PREPARE %s AS %s" % (name, query))
+            cursor.close()
+            statements[query] = name
+        return name
+
+    def close(self, discard: bool=False):
+        """
+            Give back the connection to the pool (closed if discard)
+        """
+        if self.conn is not None:
+            self.pool.release(self.conn, close=discard or self.conn.closed)
+            self.conn = None
+
+def pool_config()->Dict:
+    conf = settings.get('db_pool', {})
+    return {
+        'size': conf.get('size', DEFAULT_POOL_SIZE),
+        'check_after': conf.get('check_after', DEFAULT_CHECK_AFTER),
+        'timeout': conf.get('timeout', DEFAULT_TIMEOUT),
+    }
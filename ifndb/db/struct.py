@@ -3,8 +3,14 @@
 Table structure utilities
 
 """
-from .query import get_cursor, DbQuery, get_connexion_name
-from typing import List, Optional, Dict
+from .query import get_cursor, DbQuery, get_connexion_name, connection
+from ..config import settings
+from typing import List, Dict, Tuple
+import json
+import os
+import re
+import threading
+import time
 
 class UnknownTableException(Exception):
     pass
@@ -93,7 +99,7 @@ class TableStructDiff:
         self.only_left = []
         self.only_right = []
         
-        remains = right.columns
+        remains = list(right.columns)
         for col in left.columns:
             if col in right.columns:
                 self.common.append(col)
@@ -111,20 +117,146 @@ class TableStructDiff:
     def is_only_right(self, col):
         return col in self.only_right
 
-def get_table_struct(table, schema="public", by_ordinal=True):
-    query = "select column_name, data_type, is_nullable from information_schema.columns where table_name='%s' and table_schema='%s'" % (table, schema)
-    if by_ordinal:
-        query += " order by ordinal_position"
-    cursor = get_cursor()
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    cursor.close()
-    if len(rows) == 0:
-        raise UnknownTableException("Unable to find table %s.%s on " % (schema, table, get_connexion_name() ))
-    d = {}
-    columns = []
-    for row in rows:
-        name = row[0]
-        d[name] = ColumnDef(name, row[1], row[2])
-        columns.append(name)
-    return TableStruct(table, schema, columns, d)    
+class SchemaCache:
+    """
+        Cache of table structures, by database (connection name)
+
+        Structures of several tables are fetched with one query on pg_catalog.
+        Cache must be invalidated after a DDL changing a known table.
+        If 'schema_cache' entry is defined in settings, the cache is also stored in a file
+        'schema_cache': {'file': path of the file, 'ttl': validity in seconds (default 3600)}
+    """
+
+    QUERY = """select n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod), case when a.attnotnull then 'NO' else 'YES' end
+        from pg_catalog.pg_attribute a
+        join pg_catalog.pg_class c on c.oid = a.attrelid
+        join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+        where a.attnum > 0 and not a.attisdropped and (n.nspname, c.relname) in %s
+        order by n.nspname, c.relname, a.attnum"""
+
+    def __init__(self):
+        self.databases: Dict[str, Dict[Tuple[str, str], TableStruct]] = {}
+        self.times: Dict[str, float] = {} # Time when the structures of a database were first fetched
+        self.loaded = False
+
+    def tables(self)->Dict[Tuple[str, str], TableStruct]:
+        if not self.loaded:
+            self.load()
+        name = get_connexion_name()
+        if name not in self.databases:
+            self.databases[name] = {}
+            self.times[name] = time.time()
+        return self.databases[name]
+
+    def fetch(self, tables: List[Tuple[str, str]]):
+        """
+            Fetch the structures of the tables not already known
+            tables: list of (table, schema)
+        """
+        if connection.conn is None:
+            connection.connect()
+        known = self.tables()
+        missing = tuple(set((schema, table) for table, schema in tables if (schema, table) not in known))
+        if len(missing) == 0:
+            return
+        cursor = get_cursor()
+        cursor.execute(self.QUERY, (missing, ))
+        rows = cursor.fetchall()
+        cursor.close()
+        found = {}
+        for row in rows:
+            key = (row[0], row[1])
+            if key not in found:
+                found[key] = ([], {})
+            name = row[2]
+            columns, defs = found[key]
+            defs[name] = ColumnDef(name, normalize_format_type(row[3]), row[4])
+            columns.append(name)
+        for key, struct in found.items():
+            schema, table = key
+            known[key] = TableStruct(table, schema, struct[0], struct[1])
+        self.save()
+
+    def get(self, table, schema="public")->TableStruct:
+        self.fetch([(table, schema)])
+        known = self.tables()
+        key = (schema, table)
+        if key not in known:
+            raise UnknownTableException("Unable to find table %s.%s on %s" % (schema, table, get_connexion_name() ))
+        return known[key]
+
+    def invalidate(self, table=None, schema="public"):
+        """
+            Forget a table structure (or all if table is None), to be called after a DDL
+        """
+        if table is not None and '.' in table:
+            schema, table = table.split('.', 1)
+        for known in self.databases.values():
+            if table is None:
+                known.clear()
+            else:
+                known.pop((schema, table), None)
+        self.save()
+
+    def config(self):
+        return settings.get('schema_cache', None)
+
+    def load(self):
+        self.loaded = True
+        conf = self.config()
+        if conf is None or not os.path.exists(conf['file']):
+            return
+        ttl = conf.get('ttl', 3600)
+        try:
+            with open(conf['file'], 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # Unreadable cache is ignored, structures are fetched again
+            return
+        now = time.time()
+        for name, db in data.items():
+            if now - db['time'] > ttl:
+                continue
+            known = {}
+            for key, cols in db['tables'].items():
+                schema, table = key.split('.', 1)
+                defs = dict((c[0], ColumnDef(c[0], c[1], c[2])) for c in cols)
+                known[(schema, table)] = TableStruct(table, schema, [c[0] for c in cols], defs)
+            self.databases[name] = known
+            self.times[name] = db['time']
+
+    def save(self):
+        conf = self.config()
+        if conf is None:
+            return
+        data = {}
+        for name, known in self.databases.items():
+            tables = {}
+            for key, struct in known.items():
+                tables["%s.%s" % key] = [[c.name, c.dbtype, c.nullable] for c in struct.defs.values()]
+            data[name] = {'time': self.times[name], 'tables': tables}
+        # Written then renamed, workers of a parallel import can read the file at the same time
+        tmp = "%s.%d.%d.tmp" % (conf['file'], os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, conf['file'])
+
+def normalize_format_type(name: str)->str:
+    """
+        Type name from format_type() to the data_type name of information_schema (without type modifiers)
+    """
+    return re.sub(r'\(\d+(,\d+)?\)', '', name)
+
+schema_cache = SchemaCache()
+
+def get_table_struct(table, schema="public", by_ordinal=True)->TableStruct:
+    """
+        Structure of a table (columns are always in the ordinal order)
+    """
+    return schema_cache.get(table, schema)
+
+def prefetch_table_structs(tables: List[Tuple[str, str]]):
+    """
+        Fetch in one query the structures of several tables (list of (table, schema))
+    """
+    schema_cache.fetch(tables)
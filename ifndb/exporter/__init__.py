@@ -1,3 +1,5 @@
 from .manager import ExporterManager
 from .profile import ExportProfile, get_export_table, TableRef
-from .update import *
\ No newline at end of file
+from .update import *
+from .runner import SurveyExport, run_exports, STATUS_DONE, STATUS_ERROR
+from .state import ExportState
\ No newline at end of file
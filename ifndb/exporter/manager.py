@@ -1,6 +1,6 @@
 from .profile import ExportProfile, TableConf, TableRef
 from typing import Dict, Optional, List
-from ..db import get_table_struct, connection, DbQuery,quote_id
+from ..db import get_table_struct, prefetch_table_structs, connection, DbQuery,quote_id
 from .update import UpdateQuery, OutputColumn
 class ExportResult:
     """
@@ -50,10 +50,19 @@ class ExporterManager:
 
     def build(self, survey_name=None)->Dict[str, ExportResult]:
         connection.connect()
-        rr = {}
+        confs = []
         for name, conf in self.profile.tables.items():
             if survey_name is not None and name != survey_name:
                 continue
-            rr[name] = self.build_table(conf)
+            confs.append(conf)
+        # Fetch all the needed structures at once
+        tables = []
+        for conf in confs:
+            for ref in [conf.get_source_table(), conf.get_target_table()]:
+                tables.append((ref.name, ref.schema))
+        prefetch_table_structs(tables)
+        rr = {}
+        for conf in confs:
+            rr[conf.name] = self.build_table(conf)
         return rr
 
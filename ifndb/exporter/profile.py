@@ -2,6 +2,8 @@
 # Profile defines configuration loaded from a config file
 # A profile define for each exported table the mapping between the source and the target table
 ##
+import hashlib
+import json
 from typing import Dict, Optional, List, Tuple
 from collections import OrderedDict
 from ..common import get_table_name
@@ -73,6 +75,17 @@ class TableConf:
 
     def get_target_table(self)->TableRef:
         return get_export_table(self.name)
+
+    def fingerprint(self)->str:
+        """
+            Hash of the table configuration (source, target and mapping)
+        """
+        data = {
+            'source': str(self.get_source_table()),
+            'target': str(self.get_target_table()),
+            'mapping': [(c.target, c.source) for c in self.mapping],
+        }
+        return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
     
     def __repr__(self) -> str:
         return "Export(%s)[ %s -> %s]:\n - %s" % (self.name, self.get_source_table(), self.get_target_table(), "\n - ".join(map(repr, self.mapping)))
@@ -0,0 +1,144 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from typing import List, Optional, Tuple
+
+from ..db import connection, DbQuery
+from ..db.query import get_connexion_name
+from .update import UpdateQuery
+from .state import ExportState, source_days, changed_ranges
+
+STATUS_DONE = 'done'
+STATUS_ERROR = 'error'
+
+class SurveyExport:
+    """
+        Export of one survey of a profile (range of the source, select test, cleanup and insert in the export table)
+        Output is kept to be shown at once, as surveys can be exported at the same time
+        state: if provided, only the days changed since the last export are replaced (incremental export)
+        fingerprint: fingerprint of the survey configuration, the survey is fully exported if it changed
+        checksum: compare checksum of the rows of each day (otherwise only count and last timestamp of each day)
+    """
+    def __init__(self, name: str, update: UpdateQuery, state: Optional[ExportState]=None, fingerprint: Optional[str]=None, checksum: bool=False):
+        self.name = name
+        self.update = update
+        self.state = state
+        self.fingerprint = fingerprint
+        self.checksum = checksum
+        self.refresh = None # Replaced days (None = full range of the source)
+        self.output: List[str] = []
+        self.status = STATUS_DONE
+        self.range = None
+        self.selected: Optional[int] = None
+        self.deleted: Optional[int] = None
+        self.inserted: Optional[int] = None
+        self.duration = 0.0
+
+    def print(self, *values):
+        self.output.append(' '.join(str(v) for v in values))
+
+    def run(self, select: bool, apply: bool, dry_run: bool):
+        start = time.perf_counter()
+        try:
+            self.export(select, apply, dry_run)
+        except Exception as e:
+            self.status = STATUS_ERROR
+            self.print("Error exporting", self.name)
+            self.print(e)
+        self.duration = time.perf_counter() - start
+
+    def export(self, select: bool, apply: bool, dry_run: bool):
+        update = self.update
+        self.range = update.source_range()
+        if select:
+            select_query = update.select()
+            self.print(select_query)
+            try:
+                q = DbQuery()
+                self.selected = q.execute(select_query)
+                self.print("%d rows" % (self.selected))
+            except Exception as e:
+                self.status = STATUS_ERROR
+                self.print("Error running select query")
+                self.print(e)
+        if apply or dry_run:
+            try:
+                days = None
+                ranges = None
+                if self.state is not None:
+                    days = source_days(update, self.checksum)
+                    if self.state.is_changed(self.name, self.fingerprint):
+                        self.print("Export profile of %s changed since last incremental export, it will be fully exported" % self.name)
+                    else:
+                        previous = self.state.get(self.name)
+                        if previous is not None:
+                            ranges = changed_ranges(previous, days)
+                if ranges is None:
+                    cleanup_query = "DELETE FROM %s where timestamp >= %%s and timestamp <= %%s" % (update.target_table)
+                    queries = [(cleanup_query, (self.range[0], self.range[1]), update.query())]
+                else:
+                    self.refresh = sum((end - start).days for start, end in ranges)
+                    queries = [self.range_queries(start, end) for start, end in ranges]
+                    if len(queries) == 0:
+                        self.print("No change since last export")
+                self.replace(queries, dry_run)
+                if days is not None and not dry_run:
+                    self.state.update(self.name, self.fingerprint, days)
+            except Exception as e:
+                self.status = STATUS_ERROR
+                self.print("Error executing query")
+                self.print(e)
+
+    def range_queries(self, start: date, end: date)->Tuple[str, Tuple, str]:
+        """
+            Queries replacing the rows of the days in [start, end[
+        """
+        cleanup_query = "DELETE FROM %s where timestamp >= %%s and timestamp < %%s" % (self.update.target_table)
+        # Dates are inlined, mapping expressions can contain '%'
+        where = "\"timestamp\" >= '%s' and \"timestamp\" < '%s'" % (start.isoformat(), end.isoformat())
+        return cleanup_query, (start, end), self.update.query(where)
+
+    def replace(self, queries: List[Tuple[str, Tuple, str]], dry_run: bool):
+        q = DbQuery()
+        if dry_run:
+            for cleanup_query, params, update_query in queries:
+                self.print(cleanup_query.replace('%%s','%s') % params)
+                self.print(update_query)
+            return
+        # Readers never see the range deleted and not yet inserted
+        with connection.transaction():
+            self.deleted = 0
+            self.inserted = 0
+            for cleanup_query, params, update_query in queries:
+                self.deleted += q.execute(cleanup_query, params)
+                self.inserted += q.execute(update_query)
+
+def run_in_thread(export: SurveyExport, select: bool, apply: bool, dry_run: bool)->SurveyExport:
+    try:
+        connection.connect(verbose=False)
+        export.print(get_connexion_name())
+        export.run(select, apply, dry_run)
+    finally:
+        # Give back the connection of the thread
+        connection.close()
+    return export
+
+def run_exports(exports: List[SurveyExport], jobs: int, select: bool, apply: bool, dry_run: bool, done=None)->List[SurveyExport]:
+    """
+        Run the exports, up to jobs at the same time (each with its own connection)
+        done: called with each export once finished (in the order they finish)
+    """
+    if jobs <= 1:
+        for export in exports:
+            export.run(select, apply, dry_run)
+            if done is not None:
+                done(export)
+        return exports
+    # Connection of the current thread is not used while threads run
+    connection.close()
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='ifndb-export') as pool:
+        futures = [pool.submit(run_in_thread, export, select, apply, dry_run) for export in exports]
+        for future in as_completed(futures):
+            if done is not None:
+                done(future.result())
+    return exports
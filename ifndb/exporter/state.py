@@ -0,0 +1,94 @@
+"""
+    Incremental export
+
+    For each survey of an export profile the state keeps, for each day of the source table, the number of rows, the last timestamp
+    (high-water mark of the day) and optionally a checksum of the rows. Only days changed since the last export are deleted
+    from the export table and inserted again. State of a survey is discarded if its configuration changed (fingerprint).
+"""
+import json
+import os
+import threading
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from ..db import DbQuery
+from .update import UpdateQuery
+
+# Day => [count, last timestamp, checksum]
+Days = Dict[str, List]
+
+def source_days(update: UpdateQuery, checksum: bool=False)->Days:
+    """
+        Rows count, last timestamp (and checksum of the rows) of each day of the source table
+    """
+    if checksum:
+        checksum_expr = "md5(string_agg(md5(s::text), '' order by md5(s::text)))"
+    else:
+        checksum_expr = "null"
+    query = 'select "timestamp"::date, count(*), max("timestamp"), %s from %s s where "timestamp" is not null group by 1' % (checksum_expr, str(update.source_table))
+    days = {}
+    for day, count, last, digest in DbQuery().fetch(query):
+        days[day.isoformat()] = [count, last.isoformat(), digest]
+    return days
+
+def changed_ranges(previous: Days, current: Days)->List[Tuple[date, date]]:
+    """
+        Ranges of days (end excluded) changed between two states, days removed from the source are included
+        Checksums are compared only if both states have one
+    """
+    changed = set()
+    for day, stat in current.items():
+        before = previous.get(day)
+        if before is None or before[0] != stat[0] or before[1] != stat[1]:
+            changed.add(day)
+        elif before[2] is not None and stat[2] is not None and before[2] != stat[2]:
+            changed.add(day)
+    changed.update(day for day in previous if day not in current)
+    ranges = []
+    for day in sorted(date.fromisoformat(d) for d in changed):
+        if len(ranges) > 0 and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], day + timedelta(days=1))
+        else:
+            ranges.append((day, day + timedelta(days=1)))
+    return ranges
+
+class ExportState:
+    """
+        State of the incremental export of the surveys of a profile, stored in a json file
+        Surveys can be exported at the same time, the file is written by one thread at a time
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.surveys = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.surveys = json.load(f)
+
+    def get(self, survey: str)->Optional[Days]:
+        """
+            Days of the last export of the survey, None if the survey has no state
+        """
+        state = self.surveys.get(survey)
+        if state is None:
+            return None
+        return state['days']
+
+    def is_changed(self, survey: str, fingerprint: str)->bool:
+        """
+            True if the configuration of the survey changed since its last export
+        """
+        state = self.surveys.get(survey)
+        return state is not None and state.get('fingerprint') != fingerprint
+
+    def update(self, survey: str, fingerprint: str, days: Days):
+        """
+            Record the days of the source once exported
+        """
+        last_time = max((stat[1] for stat in days.values()), default=None)
+        with self.lock:
+            self.surveys[survey] = {'fingerprint': fingerprint, 'last_time': last_time, 'days': days}
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.surveys, f)
+            os.replace(tmp, self.path)
@@ -1,5 +1,5 @@
 from .profile import TableRef
-from typing import List
+from typing import List, Optional
 from ..db import connection, DbQuery,quote_id
 
 class OutputColumn:
@@ -19,14 +19,16 @@ class UpdateQuery:
         self.source_table:TableRef = source_table
         self.columns = columns # Target_colum and expression to populate it from the source column
 
-    def select(self):
-        print(self.source_table)
+    def select(self, where: Optional[str]=None):
         exprs = [o.expr for o in self.columns]
-        return "select %s from %s" % (",".join(exprs), str(self.source_table))
+        query = "select %s from %s" % (",".join(exprs), str(self.source_table))
+        if where is not None:
+            query += " where " + where
+        return query
 
-    def query(self):
+    def query(self, where: Optional[str]=None):
         cols = [quote_id(o.target) for o in self.columns]
-        return "insert into %s (%s) %s" % (str(self.target_table), ",".join(cols),  self.select())
+        return "insert into %s (%s) %s" % (str(self.target_table), ",".join(cols),  self.select(where))
 
     def source_range(self):
         query = 'select min("timestamp") , max("timestamp") from %s' % str(self.source_table)
@@ -0,0 +1,131 @@
+"""
+    On-disk cache of prepared data (after the preparation steps)
+
+    An entry is keyed by the hash of the source file content and the fingerprint of the table profile.
+    Each entry is a directory containing one Arrow (feather, uncompressed) file by chunk, loaded using memory mapping.
+    Total size of the cache is bounded, least recently used entries are evicted first.
+"""
+import os
+import shutil
+import hashlib
+from typing import Iterator, Optional
+
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+def hash_file(path: str)->str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def entry_size(path: str)->int:
+    size = 0
+    for name in os.listdir(path):
+        size += os.path.getsize(os.path.join(path, name))
+    return size
+
+class CacheWriter:
+    """
+        Write chunks of a new cache entry, the entry is only visible once committed
+    """
+    def __init__(self, cache: 'FrameCache', key: str):
+        self.cache = cache
+        self.key = key
+        self.path = cache.entry_path(key) + '.tmp-%d' % os.getpid()
+        self.count = 0
+        self.failed = False
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+
+    def append(self, rows: pandas.DataFrame):
+        if self.failed:
+            return
+        try:
+            feather.write_feather(rows, os.path.join(self.path, 'chunk-%05d.arrow' % self.count), compression='uncompressed')
+            self.count += 1
+        except (pyarrow.ArrowException, ValueError, TypeError) as e:
+            # Some data cannot be stored (columns with mixed types), data will not be cached
+            print("[cache] Unable to cache data: %s" % e)
+            self.abort()
+            self.failed = True
+
+    def commit(self):
+        if self.failed:
+            return
+        target = self.cache.entry_path(self.key)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(self.path, target)
+        self.cache.evict()
+
+    def abort(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class FrameCache:
+    """
+        Cache of prepared data frames
+    """
+    def __init__(self, path: str, max_size: int):
+        """
+            path: directory of the cache
+            max_size: maximum size of the cache in bytes
+        """
+        if feather is None:
+            raise Exception("pyarrow is required to use the import cache")
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, file: str, fingerprint: str)->str:
+        h = hashlib.sha256()
+        h.update(hash_file(file).encode('ascii'))
+        h.update(fingerprint.encode('ascii'))
+        return h.hexdigest()
+
+    def entry_path(self, key: str)->str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str)->Optional[Iterator[pandas.DataFrame]]:
+        """
+            Chunks of the entry or None if not in cache
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        os.utime(path) # Entry is recently used
+        files = sorted(os.listdir(path))
+        return self.read_chunks(path, files)
+
+    def read_chunks(self, path: str, files):
+        for name in files:
+            table = feather.read_table(os.path.join(path, name), memory_map=True)
+            yield table.to_pandas()
+
+    def writer(self, key: str)->CacheWriter:
+        return CacheWriter(self, key)
+
+    def evict(self):
+        """
+            Remove least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not os.path.isdir(path) or '.tmp' in name:
+                continue
+            size = entry_size(path)
+            total += size
+            entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
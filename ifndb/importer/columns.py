@@ -1,4 +1,4 @@
-from typing import Union, List
+from typing import Union, List, Dict, Tuple
 import fnmatch
 import re
 
@@ -14,9 +14,15 @@ def apply_re(pattern, values: list):
     """
         Select from a list using a re pattern
     """
-    f = lambda x:re.match(pattern) is not None
+    f = lambda x:re.match(pattern, x) is not None
     return list(filter(f, values))
 
+def compile_glob(pattern):
+    """
+        Compile a glob pattern to a regex
+    """
+    return re.compile(fnmatch.translate(pattern))
+
 class ColumnSelector:
     """
         Select a list of columns from a list of column selectors
@@ -29,6 +35,7 @@ class ColumnSelector:
     """
     def __init__(self, conf):
         self.selectors = list(self.config(conf))
+        self.selected: Dict[Tuple[str], List[str]] = {} # Selection memoized by list of columns
          
     def config(self, conf):
         if not isinstance(conf, list):
@@ -42,12 +49,16 @@ class ColumnSelector:
                         yield PatternColumnSelector(selector_conf[mode], mode)
     
     def select(self, data_columns:List[str]):
+        key = tuple(data_columns)
+        if key in self.selected:
+            return list(self.selected[key])
         columns = []
         for selector in self.selectors:
             cols = list(selector.select(data_columns))
             columns.extend(cols)
-        columns = list(set(columns)) 
-        return columns   
+        columns = list(dict.fromkeys(columns)) # Unique, keep order
+        self.selected[key] = columns
+        return list(columns)
 
     def __str__(self) -> str:
         return ','.join(map(str, self.selectors))
@@ -84,15 +95,14 @@ class PatternColumnSelector(BaseFixedColumnSelector):
         self.patterns = patterns
         self.mode = mode
         if mode == 'glob':
-            self.func = apply_glob
+            self.compiled = [compile_glob(p) for p in patterns]
         if mode == 're':
-            self.func = apply_re
+            self.compiled = [re.compile(p) for p in patterns]
     
     def select(self, data_columns:List[str]):
         out = []
-        for p in self.patterns:
-            cols = self.func(p, data_columns)
-            out.extend(cols)
+        for p in self.compiled:
+            out.extend([col for col in data_columns if p.match(col) is not None])
         return out
 
     def __str__(self) -> str:
@@ -0,0 +1,70 @@
+"""
+    Vectorized conversions of columns
+
+    Conversions are computed once by distinct value (factorize) and spread back to the rows,
+    results (values and dtype) are the same as the per-cell conversions they replace.
+"""
+import numpy
+import pandas
+from pandas.api.types import infer_dtype
+
+BOOLEANS = {'0': False, '1': True, 'true': True, 'false': False}
+
+def factorize_exact(data: pandas.Series):
+    """
+        Codes (-1 for null values) and distinct values of a column, distinct values being distinct for str()
+        Returns None if values cannot be safely factorized (object column with mixed types, as 1 == 1.0 == True)
+    """
+    dtype = data.dtype
+    if isinstance(dtype, numpy.dtype) and dtype.kind == 'f':
+        # Factorize on the bits, as 0.0 and -0.0 are equal
+        is_na = data.isna().to_numpy()
+        codes = numpy.full(len(data), -1, dtype=numpy.intp)
+        codes[~is_na], uniques = pandas.factorize(data.to_numpy()[~is_na].view('i%d' % dtype.itemsize))
+        return codes, uniques.view(dtype).tolist()
+    if isinstance(dtype, numpy.dtype) and dtype.kind in 'iub':
+        codes, uniques = pandas.factorize(data)
+        return codes, uniques.tolist()
+    if dtype == object and infer_dtype(data, skipna=True) in ('string', 'boolean', 'empty'):
+        codes, uniques = pandas.factorize(data)
+        return codes, list(uniques)
+    return None
+
+def to_boolean(data: pandas.Series, na_false: bool=False)->pandas.Series:
+    """
+        Textual representation (lowercased) of values mapped with BOOLEANS, values not in BOOLEANS are kept as lowercased strings
+        Null values are None (or False if na_false)
+        Column is of bool dtype if all values are booleans, object otherwise
+    """
+    factorized = factorize_exact(data)
+    if factorized is None:
+        na = '0' if na_false else None
+        return data.map(lambda x: str(x).lower() if not pandas.isna(x) else na).replace(BOOLEANS)
+    codes, uniques = factorized
+    mapped = numpy.empty(len(uniques), dtype=object)
+    all_bool = True
+    for index, value in enumerate(uniques):
+        label = str(value).lower()
+        v = BOOLEANS.get(label, label)
+        all_bool = all_bool and isinstance(v, bool)
+        mapped[index] = v
+    is_na = codes < 0
+    values = numpy.empty(len(data), dtype=object)
+    values[~is_na] = mapped[codes[~is_na]]
+    values[is_na] = False if na_false else None
+    if len(values) > 0 and all_bool and (na_false or not is_na.any()):
+        values = values.astype(bool)
+    return pandas.Series(values, index=data.index, name=data.name)
+
+def to_str(data: pandas.Series)->pandas.Series:
+    """
+        Values as str, null values as None
+    """
+    if isinstance(data.dtype, pandas.CategoricalDtype):
+        data = data.astype(object)
+    if isinstance(data.dtype, numpy.dtype) and data.dtype.kind in 'iub':
+        # Numpy integer and bool dtypes have no null values
+        return data.astype(str).astype(object)
+    if data.dtype == object and infer_dtype(data, skipna=True) in ('string', 'empty'):
+        return data.where(data.notna(), None)
+    return data.map(lambda x: str(x) if not pandas.isna(x) else None)
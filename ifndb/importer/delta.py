@@ -0,0 +1,155 @@
+"""
+    Incremental import
+
+    For each time window (catalog entry) the state keeps the watermark (max timestamp) and the hash of the rows of each key,
+    rows are identified by (global_id, timestamp). Only rows of new or changed keys are loaded, keys not in the source anymore are removed.
+    Rows sharing a key are replaced together, so the rows of a window must be seen at once (no chunks).
+    Rows without global_id are always loaded (their rows in the window are replaced), rows without timestamp are not loaded.
+"""
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+
+import pandas
+
+from .export import ExportColumn
+
+def row_keys(rows: pandas.DataFrame)->pandas.Series:
+    """
+        Key of rows: global_id|timestamp (as epoch in ns)
+    """
+    timestamps = rows['timestamp'].astype('int64').astype(str)
+    return rows['global_id'].astype(str) + '|' + timestamps
+
+def parse_key(key: str)->Tuple[str, datetime]:
+    global_id, ts = key.rsplit('|', 1)
+    return global_id, pandas.Timestamp(int(ts)).to_pydatetime()
+
+class WindowDelta:
+    """
+        Changes of the rows of a time window since the last import
+    """
+    def __init__(self, key: str, previous: Optional[Dict]):
+        self.key = key
+        # If no previous state, the window is fully replaced
+        self.full = previous is None
+        self.previous: Dict[str, str] = previous['rows'] if previous is not None else {}
+        self.watermark = previous['max_time'] if previous is not None else None
+        self.hashes: Dict[str, str] = {}
+        self.max_time = None
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.unkeyed = 0 # Rows without global_id, always loaded
+        self.skipped = 0 # Rows without timestamp, not loaded
+        self.removed: List[str] = []
+
+    def filter(self, rows: pandas.DataFrame, export: List[ExportColumn])->pandas.DataFrame:
+        """
+            Record hashes of the keys and returns the rows of new or changed keys
+            All the rows of the window must be given at once
+        """
+        if len(rows) == 0:
+            return rows
+        has_time = rows['timestamp'].notna()
+        unkeyed = rows['global_id'].isna() & has_time
+        keyed = rows['global_id'].notna() & has_time
+        self.unkeyed += int(unkeyed.sum())
+        if self.full:
+            self.new += int(keyed.sum())
+        else:
+            self.skipped += int((~has_time).sum())
+
+        keys = row_keys(rows[keyed])
+        key_hashes = self.key_hashes(rows[keyed], keys, export)
+        self.hashes.update(key_hashes.to_dict())
+
+        if has_time.any():
+            max_time = str(rows['timestamp'].max())
+            if self.max_time is None or max_time > self.max_time:
+                self.max_time = max_time
+
+        if self.full:
+            return rows
+
+        previous = key_hashes.index.map(self.previous)
+        new_keys = key_hashes.index[previous.isna()]
+        changed_keys = key_hashes.index[~previous.isna() & (previous != key_hashes.to_numpy())]
+        is_new = keys.isin(new_keys)
+        is_changed = keys.isin(changed_keys)
+        self.new += int(is_new.sum())
+        self.changed += int(is_changed.sum())
+        self.unchanged += len(keys) - int(is_new.sum()) - int(is_changed.sum())
+        selected = unkeyed.copy()
+        selected[keyed] = (is_new | is_changed).to_numpy()
+        return rows[selected.to_numpy()]
+
+    @staticmethod
+    def key_hashes(rows: pandas.DataFrame, keys: pandas.Series, export: List[ExportColumn])->pandas.Series:
+        """
+            Hash of the rows of each key (independent of the order of the rows), hash of the row if the key has one row
+        """
+        columns = [c.name for c in export if c.is_column()]
+        hashes = pandas.util.hash_pandas_object(rows[columns], index=False).astype(str)
+        frame = pandas.DataFrame({'key': keys.to_numpy(), 'hash': hashes.to_numpy()}).sort_values(['key', 'hash'])
+        joined = frame.groupby('key', sort=False)['hash'].agg('|'.join)
+        multiple = joined.str.contains('|', regex=False)
+        if multiple.any():
+            joined[multiple] = pandas.util.hash_array(joined[multiple].to_numpy(object)).astype(str)
+        return joined
+
+    def finish(self):
+        """
+            Compute removed rows, once all rows have been seen
+        """
+        if not self.full:
+            self.removed = [key for key in self.previous if key not in self.hashes]
+
+    def removed_keys(self)->List[Tuple[str, datetime]]:
+        return [parse_key(key) for key in self.removed]
+
+    def __str__(self):
+        if self.full:
+            return "Window %s: %d rows (no previous state, full replace)" % (self.key, self.new)
+        text = "Window %s (watermark %s): %d new, %d changed, %d unchanged, %d removed" % (self.key, self.watermark, self.new, self.changed, self.unchanged, len(self.removed))
+        if self.unkeyed > 0:
+            text += ", %d without global_id (replaced)" % self.unkeyed
+        if self.skipped > 0:
+            text += ", %d without timestamp (not loaded)" % self.skipped
+        return text
+
+class ImportState:
+    """
+        State of the incremental import of a table, stored in a json file
+        State is discarded if the profile of the table changed (fingerprint)
+    """
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.windows = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('fingerprint') == fingerprint:
+                self.windows = data['windows']
+            else:
+                print("Profile changed since last incremental import, windows will be fully replaced")
+
+    @staticmethod
+    def window_key(min_time: datetime, max_time: datetime)->str:
+        return "%s/%s" % (min_time.isoformat(), max_time.isoformat())
+
+    def delta(self, min_time: datetime, max_time: datetime)->WindowDelta:
+        key = self.window_key(min_time, max_time)
+        return WindowDelta(key, self.windows.get(key, None))
+
+    def update(self, delta: WindowDelta):
+        """
+            Record the state of a window once merged
+        """
+        self.windows[delta.key] = {'max_time': delta.max_time, 'rows': delta.hashes}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'windows': self.windows}, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,127 @@
+"""
+    Column-wise encoding of rows to be sent to the database
+
+    Each exported column is encoded in one pass: the column is factorized, only the distinct values
+    are converted to their wire representation, which is then spread back to the rows using the codes.
+"""
+from typing import List
+import struct
+import numpy
+import pandas
+
+from ..db.copy import copy_text_value, BinaryEncoder
+from .export import ExportColumn
+from .convert import factorize_exact
+
+NULL_TEXT = '\\N'
+NULL_BINARY = struct.pack('!i', -1)
+
+def to_python(value):
+    """
+        Numpy scalar to python value
+    """
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def factorize_column(rows: pandas.DataFrame, column: ExportColumn):
+    """
+        Factorize a column into codes and python values of distinct values (code is -1 for null value)
+        Values are casted according to the column conversion type (int, bool)
+    """
+    if column.is_constant():
+        return numpy.zeros(len(rows), dtype='intp'), [column.value]
+
+    series = rows[column.name]
+    if column.type == "int" or column.type == "bool":
+        mask = series.isna().to_numpy()
+        if column.type == "int":
+            if pandas.api.types.is_integer_dtype(series.dtype):
+                values = series.to_numpy(dtype='int64', na_value=0)
+            else:
+                values = series.to_numpy(dtype='float64', na_value=0).astype('int64')
+        else:
+            if pandas.api.types.is_bool_dtype(series.dtype):
+                values = series.to_numpy(dtype=bool, na_value=False)
+            else:
+                values = series.to_numpy(dtype=object, na_value=False).astype(bool)
+        codes, uniques = pandas.factorize(values)
+        codes[mask] = -1
+    else:
+        factorized = factorize_exact(series)
+        if factorized is not None:
+            codes, uniques = factorized
+        elif series.dtype != object and series.dtype.kind != 'f':
+            # Values of one type (datetimes, nullable integers...), equal values are the same
+            codes, uniques = pandas.factorize(series)
+        else:
+            # Equal values can differ once encoded (1 == 1.0 == True, 0.0 == -0.0), each value is encoded
+            is_na = series.isna().to_numpy()
+            codes = numpy.full(len(series), -1, dtype=numpy.intp)
+            codes[~is_na] = numpy.arange(int((~is_na).sum()))
+            uniques = series.to_numpy(dtype=object)[~is_na].tolist()
+    return codes, [to_python(u) for u in uniques]
+
+def spread(codes, encoded:list, null):
+    """
+        Build the column of encoded values from the codes and encoded distinct values
+    """
+    encoded.append(null) # Code -1 is the last entry
+    return numpy.array(encoded, dtype=object)[codes]
+
+class ValuesEncoder:
+    """
+        Encode rows as tuple of python values (None for null value)
+    """
+
+    def encode_column(self, rows: pandas.DataFrame, column: ExportColumn):
+        codes, uniques = factorize_column(rows, column)
+        return spread(codes, uniques, None)
+
+    def join(self, columns: list, size:int)->list:
+        return list(zip(*columns))
+
+    def encode(self, rows: pandas.DataFrame, columns: List[ExportColumn])->list:
+        encoded = []
+        for column in columns:
+            encoded.append(self.encode_column(rows, column))
+        return self.join(encoded, len(rows))
+
+class TextCopyEncoder(ValuesEncoder):
+    """
+        Encode rows as lines of the COPY text format
+    """
+
+    def encode_column(self, rows: pandas.DataFrame, column: ExportColumn):
+        codes, uniques = factorize_column(rows, column)
+        return spread(codes, [copy_text_value(u) for u in uniques], NULL_TEXT)
+
+    def join(self, columns: list, size:int)->list:
+        lines = numpy.full(size, '', dtype=object)
+        for index, column in enumerate(columns):
+            if index > 0:
+                lines = lines + '\t'
+            lines = lines + column
+        lines = lines + '\n'
+        return lines.tolist()
+
+class BinaryCopyEncoder(ValuesEncoder):
+    """
+        Encode rows as tuples of the COPY binary format
+    """
+
+    def __init__(self, encoders: List[BinaryEncoder]):
+        self.encoders = encoders
+
+    def encode(self, rows: pandas.DataFrame, columns: List[ExportColumn])->list:
+        encoded = []
+        for column, encoder in zip(columns, self.encoders):
+            codes, uniques = factorize_column(rows, column)
+            encoded.append(spread(codes, [encoder.encode(u) for u in uniques], NULL_BINARY))
+        return self.join(encoded, len(rows))
+
+    def join(self, columns: list, size:int)->list:
+        tuples = numpy.full(size, struct.pack('!h', len(columns)), dtype=object)
+        for column in columns:
+            tuples = tuples + column
+        return tuples.tolist()
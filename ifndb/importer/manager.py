@@ -1,27 +1,78 @@
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Iterator
 
 import os
 import time
+import numpy
 import pandas
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from ..db import get_cursor, connection
 from pandas import isna
 from ..db.query import DbBatch, DbFakeBatch, DbFakeQuery, DbQuery
-from ..db.struct import ColumnDef, TableStruct, get_table_struct
+from ..db.copy import DbCopy, DbBinaryCopy, DbFakeCopy
+from ..db.struct import ColumnDef, TableStruct, get_table_struct, schema_cache
 from ..db.types import normalize_db_type
 from ..db.utils import quote_id
 from ..utils import int_to_base36, read_yaml
+from ..profiling import StageProfiler, NullProfiler
 
-from .profile import Profile
+from .profile import Profile, TableConf
 from .export import ExportColumn, ExportConstant
-from .types import TYPE_COMPAT
+from .types import TYPE_COMPAT, auto_convert_type
+from .encoder import ValuesEncoder, TextCopyEncoder, BinaryCopyEncoder
+from .convert import to_str
 from .source import DataSource
+from .cache import FrameCache
+from .delta import WindowDelta
+from .preprocess import ColumnsPreprocessor
+from .planner import ImportPlan, plan_import, AUTO_IGNORE
+from .sender import BatchSender
+
+# Load modes, how rows are sent to the staging table
+LOAD_COPY = 'copy' # COPY FROM STDIN, text format
+LOAD_COPY_BINARY = 'copy-binary' # COPY FROM STDIN, binary format
+LOAD_PREPARED = 'prepared' # One EXECUTE of a prepared INSERT by row
+
+LOAD_MODES = [LOAD_COPY, LOAD_COPY_BINARY, LOAD_PREPARED]
+
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+COPY_BATCH_SIZE = 50000 # Rows by COPY
+
+DEFAULT_SEND_QUEUE = 2
+SEND_SLICE_SIZE = 10000 # Rows encoded at once when rows are sent by another thread
 
 class ImportError(Exception):
     pass
 
+class PreparedBatch:
+    """
+        Adapt a DbBatch to accept rows values, each row is sent as an EXECUTE query of a prepared statement
+    """
+    def __init__(self, batch: DbBatch, execute_query:str):
+        self.batch = batch
+        self.cursor = batch.cursor
+        self.execute_query = execute_query
+
+    def show(self, values):
+        return self.cursor.mogrify(self.execute_query, values)
+
+    def append(self, values):
+        self.batch.append(self.cursor.mogrify(self.execute_query, values))
+
+    def extend(self, rows: list):
+        for values in rows:
+            self.append(values)
+
+    def run(self):
+        self.batch.run()
+
+    @property
+    def sent(self):
+        return self.batch.sent
+
 class Importer:
 
     def __init__(self, path:Path, opts:Optional[Dict]):
@@ -34,6 +85,17 @@ class Importer:
             - dry_run : only shows queries do not really run them on database
             - show_batch : will shown N batches query
             - debug = debug mode will be very verbose
+            - load_mode : how rows are loaded in the staging table (one of LOAD_MODES, default is LOAD_COPY)
+            - chunk_size : number of rows by chunk to stream the source (0 = load the whole source at once)
+            - cache_path : directory of the prepared data cache (no cache if not provided)
+            - cache_size : maximum size of the cache in bytes
+            - bulk_ids : reserve ids of the merged rows with one sequence call (target table is locked against other writers during the merge)
+            - profile_stages : measure time, rows and memory of each stage of the import
+            - profile_output : file where stages measures are appended as json lines
+            - profile_dump : name of a stage to run under cProfile
+            - skip_unknown_columns : columns absent from the target table are not loaded (instead of raising an error)
+            - workers : number of threads used to prepare and convert columns in parallel (1 = no thread)
+            - send_queue : number of encoded slices of rows waiting to be sent by the sending thread (0 = encode and send in turn, without thread)
         """
         
         self.dry_run = 'dry_run' in opts and opts['dry_run']
@@ -47,6 +109,35 @@ class Importer:
 
         self.debug = 'debug' in opts and opts['debug']
 
+        self.load_mode = opts.get('load_mode', LOAD_COPY)
+        if self.load_mode not in LOAD_MODES:
+            raise ImportError("Unknown load mode '%s'" % (self.load_mode))
+
+        self.chunk_size = opts.get('chunk_size', 0)
+
+        self.send_queue = opts.get('send_queue', DEFAULT_SEND_QUEUE)
+
+        self.bulk_ids = opts.get('bulk_ids', False)
+
+        self.skip_unknown_columns = opts.get('skip_unknown_columns', False)
+
+        # Threads share the frame, columns are transformed without copying data between workers
+        self.pool = None
+        workers = opts.get('workers', 1)
+        if workers is not None and workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ifndb-prepare')
+        self.plans = {} # Import plans by table profile, source header and target columns
+        self.filtered: Dict[str, int] = {} # Rows filtered out of the current import, by reason
+
+        self.cache = None
+        if opts.get('cache_path'):
+            self.cache = FrameCache(opts['cache_path'], opts.get('cache_size', DEFAULT_CACHE_SIZE))
+
+        if opts.get('profile_stages'):
+            self.profiler = StageProfiler(opts.get('profile_output'), opts.get('profile_dump'))
+        else:
+            self.profiler = NullProfiler()
+
         self.path = path
         
         if not os.path.exists(self.path):
@@ -68,57 +159,286 @@ class Importer:
             Import a from a the csv file to the database
             ---
             name: name of the profile to use for import
-            csv_file: 
+            source: data source to import
+        """
+        staged = self.stage_table(name, source)
+        if staged is not None:
+            self.merge_staged(staged)
+
+    def stage_table(self, name, source:DataSource, staging_suffix:str='', delta: Optional[WindowDelta]=None)->Optional['StagedImport']:
         """
+            Load the data source into the staging table of the target table (without updating the target table)
+            ---
+            name: name of the profile to use for import
+            source: data source to import
+            staging_suffix: suffix added to the staging table name (to use distinct staging tables for the same target)
+            delta: if provided, only new or changed rows of the window are loaded (incremental import)
+
+            If chunk_size is set, the source is streamed by chunks of rows, each chunk is prepared, converted
+            and loaded before the next one is read. Export schema is decided from the first chunk.
+
+            Returns None if nothing can be imported
+        """
+        if delta is not None and self.chunk_size > 0:
+            # Rows sharing a key can be in different chunks, they must be compared at once
+            raise ImportError("Incremental import cannot stream the source by chunks (chunk_size must be 0)")
         connection.connect()
+        self.has_error = False
+        self.filtered = {}
         
         tb_conf = self.profile.get_table(name)
         if tb_conf is None:
             raise Exception("Unknow table profile '%s'" % (name))
 
-        rows = source.load(dtype=tb_conf.csv_types)
-        
+        table = tb_conf.get_table_name()
+        target = get_table_struct(table)
+
+        profiler = self.profiler
+        plan = self.plan_import(tb_conf, target, source)
+        export = None
+        load = None
+        first = True
+        # Staging table is created and loaded in one transaction (visible to other connections once complete)
+        with connection.transaction():
+            try:
+                for rows in self.prepared_chunks(tb_conf, source, plan):
+                    if export is None:
+                        export = self.build_export(tb_conf, target, rows.columns, plan.excluded)
+                    with profiler.stage('convert', len(rows)):
+                        self.convert_rows(rows, export)
+                    if delta is not None:
+                        with profiler.stage('delta', len(rows)) as run:
+                            rows = delta.filter(rows, export)
+                            run.rows_out = len(rows)
+                    if first:
+                        if self.dry_run or self.debug:
+                            rows.info(verbose=True)
+                        with profiler.stage('check', len(rows)):
+                            self.check_columns(target, rows, export)
+                        if self.has_error:
+                            print("Some errors occured. Unable to make import")
+                            return
+                        load = self.start_import(target, export, staging_suffix)
+                        first = False
+                    load.load(rows)
+                if load is not None:
+                    load.close()
+            except BaseException:
+                if load is not None:
+                    load.abort()
+                raise
+
+        self.show_filtered()
+        if load is None:
+            print("No data to import")
+            return
+
+        if delta is not None:
+            delta.finish()
+            print(delta)
+
+        if source.has_time_range():
+            min_time, max_time = source.get_time_range()
+        elif load.min_time is not None:
+            min_time = load.min_time.to_pydatetime()
+            max_time = load.max_time.to_pydatetime()
+        else:
+            min_time, max_time = None, None
+
+        return StagedImport(target, load.temp_table, min_time, max_time, load.count, delta)
+
+    def plan_import(self, tb_conf: TableConf, target: TableStruct, source: DataSource)->ImportPlan:
+        """
+            Columns to load and preparation steps to run, computed once by source header
+        """
+        header = source.header()
+        if header is None:
+            return ImportPlan([], list(range(len(tb_conf.preprocess))))
+        key = (tb_conf.table, tuple(header), tuple(target.columns))
+        if key in self.plans:
+            return self.plans[key]
+        plan = plan_import(tb_conf, target, header, self.skip_unknown_columns)
         if self.debug:
+            print(plan)
+        pruned = plan.pruned()
+        if len(pruned) > 0 and self.debug:
+            print("Columns not loaded: %s" % ', '.join(pruned))
+        for column in plan.unknown:
+            if self.skip_unknown_columns:
+                print("[warning] Column '%s' has no target column in %s, not imported" % (column, target.qualified_table()))
+        self.plans[key] = plan
+        return plan
+
+    def prepared_chunks(self, tb_conf: TableConf, source: DataSource, plan: ImportPlan)->Iterator[pandas.DataFrame]:
+        """
+            Chunks of the source after preparation steps, from the cache if available
+        """
+        if self.cache is not None and source.is_csv():
+            yield from self.cached_chunks(tb_conf, source, plan)
+            return
+        yield from self.read_chunks(tb_conf, source, plan.columns, plan.dtypes, plan.steps)
+
+    def cached_chunks(self, tb_conf: TableConf, source: DataSource, plan: ImportPlan)->Iterator[pandas.DataFrame]:
+        """
+            Prepared data do not depend on the target table (all columns are read, all steps are run, no compact dtypes)
+            so a change of the target table reuses them, columns not used by the plan are then removed and compact dtypes applied
+        """
+        fingerprint = tb_conf.fingerprint()
+        if source.has_time_range():
+            fingerprint += "%s/%s" % source.get_time_range()
+        key = self.cache.key(source.csv_file, fingerprint)
+        cached = self.cache.get(key)
+        if cached is not None:
+            print("Using cached data for %s" % source.csv_file)
+            for rows in self.profiler.iterate('cache', cached):
+                yield self.project_rows(rows, plan)
+            return
+        writer = self.cache.writer(key)
+        completed = False
+        try:
+            steps = list(range(len(tb_conf.preprocess)))
+            for rows in self.read_chunks(tb_conf, source, None, {}, steps):
+                writer.append(rows)
+                yield self.project_rows(rows, plan)
+            completed = True
+        finally:
+            if completed:
+                writer.commit()
+            else:
+                writer.abort()
+
+    def project_rows(self, rows: pandas.DataFrame, plan: ImportPlan)->pandas.DataFrame:
+        """
+            Keep the prepared columns used by the plan and apply its compact dtypes (on a copy)
+        """
+        if plan.outputs is not None:
+            rows = rows.drop(columns=[c for c in rows.columns if c not in plan.outputs])
+        else:
+            rows = rows.copy(deep=False)
+        self.cast_rows(rows, plan.output_dtypes)
+        return rows
+
+    def read_chunks(self, tb_conf: TableConf, source: DataSource, usecols: Optional[List[str]], dtypes: Dict[str, str], steps: List[int])->Iterator[pandas.DataFrame]:
+        """
+            Read the source and run the preparation steps on each chunk
+            usecols: columns to read (None = all), dtypes: compact dtypes of the source columns, steps: preparation steps to run
+        """
+        first = True
+        time_column = source.time_column if source.has_time_range() else None
+        header = source.header() if usecols is not None and time_column is not None else None
+        if header is not None and time_column in header and time_column not in usecols:
+            # Time column is only loaded to filter rows
+            usecols = [c for c in header if c in usecols or c == time_column]
+        else:
+            time_column = None
+        chunks = source.iter_chunks(dtype=tb_conf.csv_types, chunk_size=self.chunk_size, usecols=usecols)
+        for rows in self.profiler.iterate('read', chunks):
+            rows = self.filter_time(source, rows)
+            if time_column is not None:
+                rows = rows.drop(columns=[time_column])
+            self.cast_rows(rows, dtypes)
+            rows = self.prepare_rows(tb_conf, rows, first, steps)
+            first = False
+            yield rows
+
+    def filter_time(self, source: DataSource, rows: pandas.DataFrame)->pandas.DataFrame:
+        """
+            Remove rows outside the time range of the source, before any other step
+        """
+        if not source.has_time_range():
+            return rows
+        with self.profiler.stage('filter time', len(rows)) as run:
+            mask = source.time_mask(rows)
+            if mask is not None and not mask.all():
+                self.count_filtered('time range', int((~mask).sum()))
+                rows = rows.drop(index=rows.index[~mask])
+            run.rows_out = len(rows)
+        return rows
+
+    def count_filtered(self, reason: str, count: int):
+        if count > 0:
+            self.filtered[reason] = self.filtered.get(reason, 0) + count
+
+    def show_filtered(self):
+        for reason, count in self.filtered.items():
+            print("Filtered %d rows (%s)" % (count, reason))
+
+    def cast_rows(self, rows: pandas.DataFrame, dtypes: Dict[str, str]):
+        """
+            Cast columns to compact dtypes (in place), columns whose values cannot be casted are kept as read
+            Only strings are casted to category and only numbers to integers, so values are the same as if converted from the read dtype
+        """
+        for column, dtype in dtypes.items():
+            if column not in rows.columns:
+                continue
+            current = rows[column].dtype
+            if str(current) == dtype:
+                continue
+            if dtype == 'category' and current != object:
+                continue
+            if dtype.startswith('Int') and not (isinstance(current, numpy.dtype) and current.kind in 'iuf'):
+                continue
+            try:
+                rows[column] = rows[column].astype(dtype)
+            except (TypeError, ValueError, OverflowError):
+                if self.debug:
+                    print("Column '%s' kept as %s (not castable to %s)" % (column, rows[column].dtype, dtype))
+
+    def prepare_rows(self, tb_conf: TableConf, rows: pandas.DataFrame, verbose: bool, steps: Optional[List[int]]=None)->pandas.DataFrame:
+        """
+            Run preprocessors on rows
+            verbose: show debug info (only for the first chunk)
+            steps: index of the preprocessors to run (all if None)
+        """
+        verbose = verbose and self.debug
+        show_row = self.show_batch_row > 0 and self.show_batch_row in rows.index
+
+        if verbose:
             rows.info(verbose=True)
 
-        if self.show_batch_row > 0:
+        if show_row:
             print(rows.loc[self.show_batch_row].to_dict())
-        if len(tb_conf.preprocess) > 0:
-            for index, processor in enumerate(tb_conf.preprocess):
-                try:
-                    if self.debug:
-                        print(processor)
-                    rr = processor.apply(rows)
+        for step in tb_conf.pipeline.plan(list(rows.columns), steps):
+            processor = step.processor
+            try:
+                if verbose:
+                    print(processor)
+                with self.profiler.stage('preprocess %s' % step.name, len(rows)) as run:
+                    if isinstance(processor, ColumnsPreprocessor):
+                        rr = processor.apply(rows, self.pool)
+                    else:
+                        rr = processor.apply(rows)
                     if not isinstance(rr, pandas.DataFrame):
                         raise Exception("Processor must return the dataframe")
-                    rows = rr
-                except Exception as e:
-                    raise ImportError("Error running preprocessor %d" % index ) from e
-        if self.debug:
+                    run.rows_out = len(rr)
+                if processor.filters_rows:
+                    self.count_filtered("%s, step %s" % (processor, step.label), len(rows) - len(rr))
+                rows = rr
+            except Exception as e:
+                raise ImportError("Error running preprocessor %s" % step.label) from e
+        if verbose:
             rows.info(verbose=True)
 
         #rows.to_csv('debug.csv')
         
-        if self.show_batch_row > 0:
+        if show_row and self.show_batch_row in rows.index:
             print(rows.loc[self.show_batch_row].to_dict())
 
-        table = tb_conf.get_table_name()
-        target = get_table_struct(table)
-        
         if str(rows.columns.values[0]) == "Unnamed: 0":
             rows = rows.rename(columns={'Unnamed: 0':"_rowid"})
+        return rows
 
-        auto_ignore = ['engineVersion','language', '_rowid']
-        auto_add = ['global_id','timestamp']
-        columns = rows.columns
-        
-        #rows.infer_objects()
-
-        # Export schema
+    def build_export(self, tb_conf: TableConf, target: TableStruct, columns: List[str], excluded=())->List[ExportColumn]:
+        """
+            Export schema, list the columns to import and the conversion to apply on them
+            excluded: columns not to import
+        """
         export = [] # Columns to import
+
+        mapping = tb_conf.resolve_mapping(list(columns))
         
         for column in columns:
-            if column in auto_ignore:
+            if column in AUTO_IGNORE or column in excluded:
                 continue
 
             # Default strategy
@@ -126,7 +446,7 @@ class Importer:
             target_name = name
             convert_to  = None
 
-            colDef = tb_conf.get_mapping(column)
+            colDef = mapping[column]
             if not colDef is None:
             
                 if colDef.ignore:
@@ -141,24 +461,31 @@ class Importer:
                 if name in target:
                     convert_to = self.auto_convert_type(target[name])
 
-            if convert_to is not None:
-                try:
-                    rows[column] = self.convert_series(rows[column], convert_to)
-                except Exception as e:
-                    print(rows[column])
-                    print(rows[column].dtypes)
-                    print(rows[column].unique())
-                    raise Exception("Error converting %s" % column) from e
             export.append(ExportColumn(name, target_name, convert_to))
-        
-        if self.dry_run or self.debug:
-            rows.info(verbose=True)
-        
-        self.check_columns(target, rows, export)
-        if self.has_error:
-            print("Some errors occured. Unable to make import")
-            return
-        self.import_data(target, rows, export, source)
+        return export
+
+    def convert_rows(self, rows: pandas.DataFrame, export: List[ExportColumn]):
+        """
+            Apply the conversion of the export schema on the rows (in place)
+            Columns are converted by the threads of the pool if workers is set
+        """
+        columns = [column for column in export if column.is_column() and column.type is not None]
+        if self.pool is None:
+            results = [(column.name, self.convert_column(rows[column.name], column)) for column in columns]
+        else:
+            futures = [(column.name, self.pool.submit(self.convert_column, rows[column.name], column)) for column in columns]
+            results = [(name, future.result()) for name, future in futures]
+        for name, data in results:
+            rows[name] = data
+
+    def convert_column(self, data: pandas.Series, column: ExportColumn)->pandas.Series:
+        try:
+            return self.convert_series(data, column.type)
+        except Exception as e:
+            print(data)
+            print(data.dtypes)
+            print(data.unique())
+            raise Exception("Error converting %s" % column.name) from e
 
     def convert_series(self, data: pandas.Series, to:str):
         if to == 'int':
@@ -171,7 +498,7 @@ class Importer:
             #return data.map(lambda x: bool(x) if not isna(x) else None).astype(bool)
             return data.astype('boolean')
         if to == 'str':
-            return data.map( lambda x: str(x) if not isna(x) else None)
+            return to_str(data)
         if to == 'month-year':
             d = pandas.to_datetime(data, unit='s')
             return d.dt.strftime('%Y-%m')
@@ -199,110 +526,280 @@ class Importer:
             dtype = rows[data_name].dtype
             dbtype = colDef.dbtype
             ntype = normalize_db_type(dbtype)
-            compat = TYPE_COMPAT[ntype]
+            compat = TYPE_COMPAT.get(ntype)
             if compat is None:
                 self.error("Unknown db type '%s' for column '%s'" % (dbtype, data_name))  
+                continue
             if not str(dtype) in compat:
                 self.error("Column '%s' : type %s (%s) is not registred as compatible with '%s'" % (data_name, dbtype, ntype, dtype)) 
         
     def auto_convert_type(self, colDef: ColumnDef):
-        dbtype = normalize_db_type(colDef.get_type())
-        if dbtype == 'int':
-            return 'int'
-        if dbtype == 'timestamp with time zone':
-            return 'timestamp'
-        if dbtype == 'date':
-            return 'date'
-        if dbtype == 'bool':
-            return 'bool'
-        if dbtype == 'text' or dbtype == 'varying':
-            return 'str'
-        return None
+        return auto_convert_type(colDef.get_type())
     
-    def import_data(self, target:TableStruct, rows: pandas.DataFrame, columns: List[ExportColumn], source: DataSource):
-        plan = 'import_' + int_to_base36(int(time.time()))
+    def create_prepared_batch(self, db:DbQuery, cursor, temp_table:str, columns: List[ExportColumn]):
+        """
+            Batch of EXECUTE queries of a prepared INSERT statement (one query by row)
+            Returns the batch and the encoder of rows values
+        """
+        vars = []
+        cols = []
+        params = [] # List of parameters to add
+        p = '%' + 's'
+        for idx, col in enumerate(columns):
+            cols.append(quote_id(col.target))
+            vars.append("$%d" % ( idx+1, ))
+            params.append(p) # List of parameters will be used to create the query
+        
+        query = "INSERT INTO %s(%s) VALUES (%s)" % (temp_table , ",".join(cols), ",".join(vars))
+
+        if self.dry_run:
+            plan = 'import_' + int_to_base36(int(time.time()))
+            db.execute("PREPARE %s AS %s" % (plan, query))
+        else:
+            # Statement is prepared once by connection, imports of the next files reuse it
+            plan = connection.prepare(query)
+
+        execute_query = "EXECUTE %s (%s)" % (plan, ",".join(params))
+        # Queries are sent by groups whose size adapts to the round trip time
+        if self.dry_run:
+            batch = DbFakeBatch(cursor)
+        else:
+            batch = DbBatch(cursor)
+        return PreparedBatch(batch, execute_query), ValuesEncoder()
 
+    def create_copy_batch(self, cursor, temp_table:str, target:TableStruct, columns: List[ExportColumn]):
+        """
+            COPY based batch, rows are streamed to the staging table
+            Returns the batch and the encoder producing the rows in its format
+        """
+        batch_size = COPY_BATCH_SIZE
+        cols = [quote_id(col.target) for col in columns]
+        if self.dry_run:
+            return DbFakeCopy(cursor, temp_table, cols, batch_size), TextCopyEncoder()
+        if self.load_mode == LOAD_COPY_BINARY:
+            types = [target[col.target].get_type() for col in columns]
+            batch = DbBinaryCopy(cursor, temp_table, cols, types, batch_size)
+            return batch, BinaryCopyEncoder(batch.encoders)
+        return DbCopy(cursor, temp_table, cols, batch_size), TextCopyEncoder()
+
+    def start_import(self, target:TableStruct, columns: List[ExportColumn], staging_suffix:str='')->'ImportLoad':
+        """
+            Create the staging table and the batch used to load rows into it
+        """
         if self.dry_run:
             # Use a logger runner 
             db = DbFakeQuery() 
         else:
             db = DbQuery()
        
-        temp_table = target.qualified_table() + '_import'
+        temp_table = target.qualified_table() + '_import' + staging_suffix
 
         print("Creating %s " % temp_table)
 
         db.execute("DROP TABLE IF EXISTS %s" % temp_table)
-        db.execute("CREATE TABLE %s (like %s)" % (temp_table, target.qualified_table()))
+        # Unlogged, staging data are not written to WAL (a temporary table cannot be used as staging tables can be merged from another connection)
+        db.execute("CREATE UNLOGGED TABLE %s (like %s)" % (temp_table, target.qualified_table()))
         db.execute("ALTER TABLE %s DROP COLUMN id" % (temp_table)) # Remove id columns so it uses sequence when imported
-        vars = []
-        cols = []
-        params = [] # List of parameters to add
-        p = '%' + 's'
-        for idx, col in enumerate(columns):
-            cols.append(quote_id(col.target))
-            vars.append("$%d" % ( idx+1, ))
-            params.append(p) # List of parameters will be used to create the query
+        schema_cache.invalidate(temp_table)
         
-        query = "PREPARE %s AS INSERT INTO %s(%s) VALUES (%s)" % (plan, temp_table , ",".join(cols), ",".join(vars))
-        
-        db.execute(query)
-
-        execute_query = "EXECUTE %s (%s)" % (plan, ",".join(params))
-       
-        batch_size = 2000
         cursor = get_cursor()
-        
-        # Need to show rows values
-        shown = 0  # Count shown in case of show_batch_count
-        need_show = self.show_batch_row > 0 or self.show_batch_count > 0
 
+        if self.load_mode == LOAD_PREPARED:
+            batch, encoder = self.create_prepared_batch(db, cursor, temp_table, columns)
+        else:
+            batch, encoder = self.create_copy_batch(cursor, temp_table, target, columns)
+
+        return ImportLoad(self, db, target, temp_table, columns, cursor, batch, encoder)
+
+    def merge_staged(self, staged: 'StagedImport', drop_staging=False)->'MergeResult':
+        """
+            Replace the imported time range in the target table by the rows of the staging table
+            Delete and insert are done in one transaction, so readers never see a partially replaced range
+        """
         if self.dry_run:
-            batch = DbFakeBatch(cursor, batch_size)
+            db = DbFakeQuery() 
         else:
-            batch = DbBatch(cursor, batch_size)
-        for idx, row in rows.iterrows():
-            vv = []
-            for column in columns:
-                if column.is_constant():
-                    vv.append(column.value)
-                    continue
-                value = row[column.name]
-                if isna(value):
-                    value = None
+            db = DbQuery()
+        target = staged.target
+        target_table = target.qualified_table()
+        result = MergeResult(target_table)
+        start = time.time()
+        with self.profiler.stage('merge', staged.count):
+            try:
+                sequence = "pg_get_serial_sequence('%s', 'id')" % (target_table, )
+                if self.bulk_ids and not self.dry_run:
+                    # Lock the target table against concurrent writers, so ids can be reserved in one call
+                    db.execute("LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE" % target_table, do_commit=False)
+                if staged.is_incremental():
+                    result.deleted = self.delete_delta(db, staged)
+                elif staged.min_time is not None:
+                    result.deleted = db.execute("delete from %s where timestamp >= %%s and timestamp <= %%s" % target_table, (staged.min_time, staged.max_time), do_commit=False)
+                result.delete_time = time.time() - start
+                if self.bulk_ids and not self.dry_run:
+                    count = db.fetch("select count(*) from %s" % staged.temp_table, 'one')[0]
+                    if count > 0:
+                        first_id = db.fetch("select nextval(%s)" % sequence, 'one')[0]
+                        db.execute("select setval(%s, %%s)" % sequence, (first_id + count - 1, ), do_commit=False)
+                        query = "insert into %s select %d + row_number() over () - 1, * from %s" % (target_table, first_id, staged.temp_table)
+                        result.inserted = db.execute(query, do_commit=False)
                 else:
-                    if(column.type == "int"):
-                        value = int(value)
-                    if(column.type == "bool"):
-                        value = bool(value)
-                vv.append(value)
-            qq = cursor.mogrify(execute_query, vv)
-            batch.append(qq)
-
-            # Show given rows (for debug purpose)
-            if need_show:
-                to_show = False
-                if self.show_batch_count > 0 and shown < self.show_batch_count:
-                    to_show = True
-                    shown += 1
-                if self.show_batch_row > 0 and idx == self.show_batch_row:
-                    to_show = True
-                if to_show:
-                    print("------")
-                    print(row.dtypes)
-                    print(row.to_dict())
-                    print(qq)
-            
-        batch.run()
-        cursor.close()
+                    result.inserted = db.execute("insert into %s select nextval(%s), * from %s" % (target_table, sequence, staged.temp_table), do_commit=False)
+                result.insert_time = time.time() - start - result.delete_time
+                if drop_staging:
+                    db.execute("DROP TABLE IF EXISTS %s" % staged.temp_table, do_commit=False)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        result.total_time = time.time() - start
+        print(result)
+        return result
+
+    def drop_staged(self, staged: 'StagedImport'):
+        """
+            Drop the staging table of an import which will not be merged
+        """
+        if self.dry_run:
+            db = DbFakeQuery()
+        else:
+            db = DbQuery()
+        db.execute("DROP TABLE IF EXISTS %s" % staged.temp_table)
 
-        if source.has_time_range():
-            min_time, max_time = source.get_time_range()
+    def delete_delta(self, db: DbQuery, staged: 'StagedImport')->int:
+        """
+            Delete rows replaced by the staging table rows and rows removed from the window (incremental import)
+        """
+        target_table = staged.target.qualified_table()
+        query = "delete from %s t using %s s where t.global_id = s.global_id and t.timestamp = s.timestamp" % (target_table, staged.temp_table)
+        deleted = db.execute(query, do_commit=False)
+        if staged.min_time is not None:
+            # Rows without global_id cannot be matched, all of them are loaded again
+            query = "delete from %s where global_id is null and timestamp >= %%s and timestamp <= %%s" % (target_table, )
+            deleted += db.execute(query, (staged.min_time, staged.max_time), do_commit=False)
+        removed = staged.delta.removed_keys()
+        size = 1000
+        for index in range(0, len(removed), size):
+            keys = tuple(removed[index:index + size])
+            deleted += db.execute("delete from %s where (global_id, timestamp) in %%s" % (target_table, ), (keys, ), do_commit=False)
+        return deleted
+
+class MergeResult:
+    """
+        Report of the merge of a staging table into the target table
+    """
+    def __init__(self, target_table: str):
+        self.target_table = target_table
+        self.deleted = 0
+        self.inserted = 0
+        self.delete_time = 0.0
+        self.insert_time = 0.0
+        self.total_time = 0.0
+
+    def __str__(self):
+        return "Merged into %s: %d deleted (%.2fs), %d inserted (%.2fs), %.2fs" % (self.target_table, self.deleted, self.delete_time, self.inserted, self.insert_time, self.total_time)
+
+class StagedImport:
+    """
+        Data loaded in a staging table, waiting to be merged into the target table
+    """
+    def __init__(self, target: TableStruct, temp_table: str, min_time, max_time, count: int, delta: Optional[WindowDelta]=None):
+        self.target = target
+        self.temp_table = temp_table
+        self.min_time = min_time
+        self.max_time = max_time
+        self.count = count
+        self.delta = delta
+
+    def is_incremental(self)->bool:
+        return self.delta is not None and not self.delta.full
+
+class ImportLoad:
+    """
+        Load of rows into the staging table, rows can be loaded in several chunks
+    """
+    def __init__(self, importer: Importer, db: DbQuery, target: TableStruct, temp_table: str, columns: List[ExportColumn], cursor, batch, encoder):
+        self.importer = importer
+        self.db = db
+        self.target = target
+        self.temp_table = temp_table
+        self.columns = columns
+        self.cursor = cursor
+        self.batch = batch
+        self.encoder = encoder
+        self.shown = 0 # Count shown in case of show_batch_count
+        self.min_time = None
+        self.max_time = None
+        self.count = 0
+        # Rows are sent by another thread while the next ones are encoded
+        self.sender = None
+        if importer.send_queue > 0:
+            self.sender = BatchSender(batch, importer.profiler, importer.send_queue)
+        self.pending_show = []
+
+    def load(self, rows: pandas.DataFrame):
+        importer = self.importer
+        profiler = importer.profiler
+        if self.sender is None:
+            with profiler.stage('encode', len(rows)):
+                payloads = self.encoder.encode(rows, self.columns)
+            with profiler.stage('send', len(rows)) as run:
+                sent = self.batch.sent
+                self.batch.extend(payloads)
+                run.bytes_sent = self.batch.sent - sent
         else:
-            min_time = rows['timestamp'].min().to_pydatetime()
-            max_time = rows['timestamp'].max().to_pydatetime()
-        
-        target_table = target.qualified_table()
-        db.execute("delete from %s where timestamp >= %%s and timestamp <= %%s" % target_table, (min_time, max_time))
-        db.execute("insert into %s select nextval(pg_get_serial_sequence('%s', 'id')), * from %s" % (target_table, target.table_name, temp_table))
-            
\ No newline at end of file
+            # Encoded by slices, so the first rows are sent while the next ones are encoded
+            for start in range(0, len(rows), SEND_SLICE_SIZE):
+                part = rows.iloc[start:start + SEND_SLICE_SIZE]
+                with profiler.stage('encode', len(part)):
+                    payloads = self.encoder.encode(part, self.columns)
+                with profiler.stage('send wait', len(part)):
+                    self.sender.put(payloads, len(part))
+
+        # Show given rows (for debug purpose)
+        if importer.show_batch_row > 0 or importer.show_batch_count > 0:
+            positions = list(range(min(importer.show_batch_count - self.shown, len(rows))))
+            self.shown += len(positions)
+            if importer.show_batch_row > 0:
+                positions.extend(numpy.flatnonzero(rows.index == importer.show_batch_row))
+            for position in positions:
+                payload = self.encoder.encode(rows.iloc[[position]], self.columns)[0]
+                if self.sender is None:
+                    self.show(rows.iloc[position], payload)
+                else:
+                    # Batch cursor is used by the sending thread, rows are shown once it is closed
+                    self.pending_show.append((rows.iloc[position], payload))
+
+        self.count += len(rows)
+
+        if 'timestamp' in rows.columns and rows['timestamp'].notna().any():
+            min_time = rows['timestamp'].min()
+            max_time = rows['timestamp'].max()
+            if self.min_time is None or min_time < self.min_time:
+                self.min_time = min_time
+            if self.max_time is None or max_time > self.max_time:
+                self.max_time = max_time
+
+    def show(self, row: pandas.Series, payload):
+        print("------")
+        print(row.dtypes)
+        print(row.to_dict())
+        print(self.batch.show(payload))
+
+    def close(self):
+        if self.sender is not None:
+            with self.importer.profiler.stage('send wait'):
+                self.sender.close()
+            for row, payload in self.pending_show:
+                self.show(row, payload)
+        with self.importer.profiler.stage('send') as run:
+            sent = self.batch.sent
+            self.batch.run()
+            run.bytes_sent = self.batch.sent - sent
+        self.cursor.close()
+
+    def abort(self):
+        """
+            Stop sending rows (import failed), the transaction can then be rolled back
+        """
+        if self.sender is not None:
+            self.sender.abort()
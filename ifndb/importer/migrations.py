@@ -0,0 +1,85 @@
+"""
+    Lookup of migrated global_id
+
+    migrations.json is indexed once into a sqlite file (next to the json file, rebuilt when the json file changes),
+    so only the ids present in the imported data are looked up instead of loading the whole file for each import.
+"""
+import os
+import json
+import sqlite3
+from typing import Dict, List, Optional
+
+# Maximum number of parameters by sqlite query
+LOOKUP_SIZE = 500
+
+class MigrationIndex:
+
+    def __init__(self, file: str):
+        self.file = file
+        self.path = file + '.sqlite'
+        self.db: Optional[sqlite3.Connection] = None
+        self.data: Optional[Dict[str, str]] = None # In memory data, if the index cannot be used
+
+    def signature(self)->str:
+        st = os.stat(self.file)
+        return "%d:%d" % (st.st_size, st.st_mtime_ns)
+
+    def open(self):
+        if self.db is not None or self.data is not None:
+            return
+        signature = self.signature()
+        try:
+            if self.read_signature() != signature:
+                self.build(signature)
+            self.db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True, check_same_thread=False)
+        except (OSError, sqlite3.Error) as e:
+            print("[migration] Unable to use index %s (%s), using json file" % (self.path, e))
+            with open(self.file, 'r') as f:
+                self.data = json.load(f)
+
+    def read_signature(self)->Optional[str]:
+        if not os.path.exists(self.path):
+            return None
+        db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+        try:
+            row = db.execute("select value from meta where name='signature'").fetchone()
+        except sqlite3.Error:
+            row = None
+        finally:
+            db.close()
+        return row[0] if row is not None else None
+
+    def build(self, signature: str):
+        """
+            Create the index from the json file, the new index replaces the old one once complete
+        """
+        print("[migration] Building index %s" % self.path)
+        with open(self.file, 'r') as f:
+            data = json.load(f)
+        tmp = self.path + '.tmp-%d' % os.getpid()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        try:
+            db.execute("create table migrations (global_id text primary key, migrated text) without rowid")
+            db.execute("create table meta (name text primary key, value text)")
+            db.executemany("insert into migrations values (?, ?)", data.items())
+            db.execute("insert into meta values ('signature', ?)", (signature, ))
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp, self.path)
+
+    def lookup(self, ids: List[str])->Dict[str, str]:
+        """
+            Migrated ids of the given ids (only ids with a migration are in the result)
+        """
+        self.open()
+        if self.data is not None:
+            return {v: self.data[v] for v in ids if v in self.data}
+        found = {}
+        for start in range(0, len(ids), LOOKUP_SIZE):
+            keys = ids[start:start + LOOKUP_SIZE]
+            query = "select global_id, migrated from migrations where global_id in (%s)" % ",".join(['?'] * len(keys))
+            found.update(self.db.execute(query, keys).fetchall())
+        return found
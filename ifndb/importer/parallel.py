@@ -0,0 +1,33 @@
+"""
+    Workers to stage several files in parallel (one process by worker)
+
+    Each worker process loads the profile once and uses its own database connection
+"""
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+
+from ..config import settings
+from .manager import Importer, StagedImport
+from .source import CSVDataSource
+from .delta import WindowDelta
+
+_importer: Optional[Importer] = None
+
+def init_worker(config: Dict, path: str, opts: Dict, profile_file: str):
+    """
+        Initialize a worker process
+    """
+    global _importer
+    settings.update(config)
+    _importer = Importer(path, opts)
+    _importer.load_profile(profile_file)
+
+def stage_file(table: str, file: str, min_time: datetime, max_time: datetime, staging_suffix: str, delta: Optional[WindowDelta]=None)->Tuple[Optional[StagedImport], List[Dict]]:
+    """
+        Load a catalog file into its own staging table
+        Returns the staged import and the stages measures (empty if stage profiling is not enabled)
+    """
+    source = CSVDataSource(file, 'submitted')
+    source.set_time_range(min_time, max_time)
+    staged = _importer.stage_table(table, source, staging_suffix, delta)
+    return staged, _importer.profiler.collect()
@@ -0,0 +1,163 @@
+"""
+    Execution of the preparation steps
+
+    Using the columns declared by each step (lineage), steps changing nothing are skipped, null keys filters (skip_if_null)
+    are moved before the row wise steps only renaming their columns, and consecutive steps are fused:
+    renaming steps into one renaming, column steps into one pass where transforms of the same column are chained.
+    The plan is computed once by header.
+"""
+from typing import Dict, List, Optional, Set, Tuple
+
+from .preprocess import BasePreprocessor, ColumnsPreprocessor, LabelsPreprocessor, FusedColumnsPreprocessor, FusedLabelsPreprocessor
+from .preprocess import Lineage, SkipIfNullProcessor, NullKeysFilter
+
+class Step:
+    """
+        One or several fused preprocessors, identified by their index in the profile
+    """
+    def __init__(self, index: int, processor: BasePreprocessor):
+        self.indexes = [index]
+        self.processors = [processor]
+
+    def add(self, index: int, processor: BasePreprocessor):
+        self.indexes.append(index)
+        self.processors.append(processor)
+
+    def is_fused(self)->bool:
+        return len(self.processors) > 1
+
+    def processor(self)->BasePreprocessor:
+        if not self.is_fused():
+            return self.processors[0]
+        if isinstance(self.processors[0], LabelsPreprocessor):
+            return FusedLabelsPreprocessor(self.processors)
+        return FusedColumnsPreprocessor(self.processors)
+
+    def label(self)->str:
+        return '+'.join(map(str, self.indexes))
+
+    def name(self)->str:
+        return ' '.join([self.label()] + [p.__class__.__name__ for p in self.processors])
+
+class Task:
+    """
+        Preprocessor to run, with the columns it gets and its lineage on them (None if unknown)
+    """
+    def __init__(self, index: int, processor: BasePreprocessor, columns: Optional[List[str]], lineage: Optional[Lineage]):
+        self.index = index
+        self.processor = processor
+        self.columns = columns
+        self.lineage = lineage
+
+class PlannedStep:
+    """
+        Step ready to run
+    """
+    def __init__(self, step: Step):
+        self.label = step.label()
+        self.name = step.name()
+        self.processor = step.processor()
+
+class Pipeline:
+
+    def __init__(self, preprocess: List[BasePreprocessor]):
+        self.preprocess = preprocess
+        self.plans: Dict[Tuple, List[PlannedStep]] = {}
+
+    def plan(self, header: List[str], enabled: Optional[List[int]]=None)->List[PlannedStep]:
+        """
+            Steps to run on data with the given columns
+            enabled: index of the preprocessors to run (all if None)
+        """
+        key = (tuple(header), None if enabled is None else tuple(enabled))
+        if key not in self.plans:
+            self.plans[key] = [PlannedStep(step) for step in self.build(list(header), enabled)]
+        return self.plans[key]
+
+    def schedule(self, columns: Optional[List[str]], enabled: Optional[List[int]])->List[Task]:
+        """
+            Preprocessors to run, in order, with the columns they get (None if unknown)
+            Preprocessors changing nothing are removed, null keys filters are moved as early as possible
+        """
+        tasks: List[Task] = []
+        for index, processor in enumerate(self.preprocess):
+            if enabled is not None and index not in enabled:
+                continue
+            lineage = None
+            if columns is not None:
+                try:
+                    lineage = processor.lineage(columns)
+                except Exception:
+                    lineage = None # Error will be raised when the step is run
+            if lineage is not None and processor.is_noop(columns):
+                continue
+            if lineage is not None and isinstance(processor, SkipIfNullProcessor):
+                position, keys = self.push_filter(tasks, processor.keys(columns))
+                if position < len(tasks):
+                    before = tasks[position].columns
+                    tasks.insert(position, Task(index, NullKeysFilter(processor, keys), before, Lineage(before)))
+                    continue
+            tasks.append(Task(index, processor, columns, lineage))
+            columns = list(lineage.outputs.keys()) if lineage is not None else None
+        return tasks
+
+    def push_filter(self, tasks: List[Task], keys: List[str])->Tuple[int, List[str]]:
+        """
+            Earliest position a filter on the key columns can be run at, and the names of the key columns at this position
+            A filter can be moved before row wise steps not computing the key columns (only renaming them)
+        """
+        position = len(tasks)
+        while position > 0:
+            task = tasks[position - 1]
+            if task.lineage is None or not task.processor.row_wise:
+                break
+            previous = []
+            for key in keys:
+                sources = task.lineage.outputs.get(key)
+                if task.lineage.relabel:
+                    if sources is None or len(sources) != 1:
+                        break
+                    previous.append(sources[0])
+                elif key in task.lineage.written:
+                    break
+                else:
+                    previous.append(key)
+            if len(previous) != len(keys):
+                break
+            keys = previous
+            position -= 1
+        return position, keys
+
+    def build(self, columns: Optional[List[str]], enabled: Optional[List[int]])->List[Step]:
+        steps: List[Step] = []
+        written: Set[str] = set() # Columns written by the last step, if it is a group of column steps
+        for task in self.schedule(columns, enabled):
+            last = steps[-1] if len(steps) > 0 else None
+            if task.lineage is not None and last is not None and self.can_fuse(last, task.processor, task.columns, written):
+                last.add(task.index, task.processor)
+            else:
+                last = Step(task.index, task.processor)
+                steps.append(last)
+                written = set()
+            if task.lineage is not None and isinstance(task.processor, ColumnsPreprocessor):
+                written.update(task.lineage.written)
+        return steps
+
+    def can_fuse(self, last: Step, processor: BasePreprocessor, columns: List[str], written: Set[str])->bool:
+        """
+            Check if the processor can be fused with the last step
+        """
+        previous = last.processors[-1]
+        if isinstance(processor, LabelsPreprocessor) and isinstance(previous, LabelsPreprocessor):
+            return True
+        if not (isinstance(processor, ColumnsPreprocessor) and isinstance(previous, ColumnsPreprocessor)):
+            return False
+        try:
+            tasks = processor.columns(columns)
+        except Exception:
+            return False # Error will be raised when the step is run
+        for source, target in tasks:
+            # A column written by the group can only be transformed again in place
+            if source != target and (source in written or target in written):
+                return False
+        return True
@@ -0,0 +1,179 @@
+"""
+    Import plan: which source columns and preparation steps are needed to produce the imported columns
+
+    The lineage of the columns is followed backward through the preparation steps, from the columns reaching
+    the target table to the columns of the source. Only those columns are loaded, steps producing only unused columns are skipped.
+
+    Source columns reaching a target column without being transformed by a dtype dependent step are casted, once read,
+    to a compact dtype derived from the target column type (nullable integers, booleans, categories for strings).
+"""
+import hashlib
+from typing import Dict, List, Optional, Set
+
+from ..db.struct import TableStruct
+from .profile import TableConf
+from .preprocess import Lineage
+from .types import INT_READ_DTYPES, auto_convert_type
+from ..db.types import normalize_db_type
+
+# Columns never imported
+AUTO_IGNORE = ['engineVersion', 'language', '_rowid']
+
+# Columns used by the import itself (time range, incremental import)
+ALWAYS_USED = ['global_id', 'timestamp']
+
+class ImportPlan:
+    """
+        columns: source columns to load (None = all the columns)
+        steps: index of the preparation steps to run
+        unknown: prepared columns whose target column is not in the target table
+        excluded: prepared columns not to import (unknown columns, if they are skipped)
+        dtypes: compact dtype of source columns, applied once read (columns are kept as read if the values cannot be casted)
+        outputs: prepared columns used by the import (None = all the columns)
+        output_dtypes: compact dtype of the prepared columns (same as dtypes, by prepared column)
+    """
+    def __init__(self, header: List[str], steps: List[int]):
+        self.header = header
+        self.columns: Optional[List[str]] = None
+        self.steps = steps
+        self.unknown: List[str] = []
+        self.excluded: Set[str] = set()
+        self.dtypes: Dict[str, str] = {}
+        self.outputs: Optional[Set[str]] = None
+        self.output_dtypes: Dict[str, str] = {}
+
+    def pruned(self)->List[str]:
+        if self.columns is None:
+            return []
+        columns = set(self.columns)
+        return [c for c in self.header if c not in columns]
+
+    def fingerprint(self)->str:
+        h = hashlib.sha256()
+        h.update(repr((self.columns, self.steps, sorted(self.excluded), sorted(self.dtypes.items()))).encode('utf-8'))
+        return h.hexdigest()
+
+    def __str__(self):
+        loaded = len(self.header) if self.columns is None else len(self.columns)
+        return "Plan: %d/%d columns loaded, steps %s" % (loaded, len(self.header), ','.join(map(str, self.steps)))
+
+def target_name(tb_conf: TableConf, column: str)->Optional[str]:
+    """
+        Name of the target column of a prepared column, None if the column is not imported
+    """
+    if column in AUTO_IGNORE:
+        return None
+    colDef = tb_conf.get_mapping(column)
+    if colDef is None:
+        return column
+    if colDef.ignore:
+        return None
+    if colDef.rename is not None:
+        return colDef.rename
+    return column
+
+def compact_dtype(tb_conf: TableConf, target: TableStruct, column: str)->Optional[str]:
+    """
+        Compact dtype of a column imported unchanged, None if no compact dtype
+    """
+    name = target_name(tb_conf, column)
+    if name is None or name not in target:
+        return None
+    dbtype = target[name].get_type()
+    colDef = tb_conf.get_mapping(column)
+    convert_to = colDef.to if colDef is not None else None
+    if convert_to is None:
+        convert_to = auto_convert_type(dbtype)
+    ntype = normalize_db_type(dbtype)
+    if convert_to == 'int' and ntype in INT_READ_DTYPES:
+        return INT_READ_DTYPES[ntype]
+    if convert_to == 'bool' and ntype == 'bool':
+        return 'boolean'
+    if convert_to == 'str' and ntype in ['text', 'varying']:
+        return 'category'
+    return None
+
+def plan_import(tb_conf: TableConf, target: TableStruct, header: List[str], skip_unknown: bool=False)->ImportPlan:
+    """
+        Plan the import of a source with the given header
+        skip_unknown: columns not in the target table are not imported (an error is raised at import otherwise)
+    """
+    steps = list(range(len(tb_conf.preprocess)))
+    lineages: List[Lineage] = []
+    columns = list(header)
+    origins = {c: c for c in header} # Source column of the columns not transformed by dtype dependent steps
+    tainted = set() # Source columns transformed by a dtype dependent step
+    for processor in tb_conf.preprocess:
+        lineage = processor.lineage(columns)
+        if lineage is None:
+            # Unknown lineage, every column is used
+            return ImportPlan(list(header), steps)
+        lineages.append(lineage)
+        columns = list(lineage.outputs.keys())
+        origins, touched = follow_origins(origins, processor, lineage)
+        if not processor.dtype_safe:
+            tainted.update(touched)
+
+    plan = ImportPlan(list(header), [])
+
+    if len(columns) > 0 and str(columns[0]) == "Unnamed: 0":
+        columns = ['_rowid'] + columns[1:]
+
+    used = set()
+    for column in columns:
+        name = target_name(tb_conf, column)
+        if name is None:
+            continue
+        if name not in target:
+            plan.unknown.append(column)
+            if skip_unknown:
+                plan.excluded.add(column)
+                continue
+        used.add(column)
+    used.update(c for c in ALWAYS_USED if c in columns)
+    plan.outputs = set(used)
+
+    for index in reversed(steps):
+        lineage = lineages[index]
+        if not (lineage.relabel or lineage.required or (lineage.written & used)):
+            continue # Step only produces unused columns
+        plan.steps.insert(0, index)
+        sources = set(lineage.required)
+        for column in used:
+            sources.update(lineage.outputs.get(column, [column]))
+        used = sources
+
+    if any(c not in used for c in header):
+        plan.columns = [c for c in header if c in used]
+
+    csv_types = tb_conf.csv_types or {}
+    for column, origin in origins.items():
+        if origin in tainted or origin in csv_types or origin not in used or column in plan.excluded:
+            continue
+        dtype = compact_dtype(tb_conf, target, column)
+        if dtype is not None:
+            plan.dtypes[origin] = dtype
+            plan.output_dtypes[column] = dtype
+    return plan
+
+def follow_origins(origins: Dict[str, str], processor, lineage: Lineage):
+    """
+        Origins of the output columns of a step, and the source columns the step read or wrote
+    """
+    outputs = {}
+    touched = set()
+    for column, sources in lineage.outputs.items():
+        if lineage.relabel:
+            if len(sources) == 1 and sources[0] in origins:
+                outputs[column] = origins[sources[0]]
+            else:
+                touched.update(origins[s] for s in sources if s in origins)
+            continue
+        if column in lineage.written:
+            touched.update(origins[s] for s in sources if s in origins)
+            if sources != [column]:
+                continue # New column computed from others
+        if column in origins:
+            outputs[column] = origins[column]
+    touched.update(origins[c] for c in lineage.required if c in origins)
+    return outputs, touched
@@ -1,10 +1,32 @@
 import pandas
+import numpy
 import re
 import json
 from pandas import isna
 import base64
 import sys
+import os
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from concurrent.futures import Executor
 from .columns import ColumnSelector
+from .migrations import MigrationIndex
+from .convert import to_boolean
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(value):
+    """
+        Parse json using orjson if available, falls back to json module for payloads orjson rejects (NaN, big ints...)
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(value)
+        except ValueError:
+            pass
+    return json.loads(value)
 
 def encode_global_id(v):
     """
@@ -16,33 +38,236 @@ def encode_global_id(v):
     return base64.urlsafe_b64encode(b).decode('utf-8')
 
 
+class Lineage:
+    """
+        Columns produced by a preprocessor from a list of input columns
+        outputs: output columns and the input columns each one is computed from (columns not written are passed through)
+        written: output columns written by the preprocessor
+        required: input columns read whatever the outputs used (e.g. to filter rows)
+        relabel: the preprocessor renames columns
+    """
+    def __init__(self, columns: List[str]):
+        self.outputs: Dict[str, List[str]] = {column: [column] for column in columns}
+        self.written = set()
+        self.required = set()
+        self.relabel = False
+
+    def write(self, column: str, sources: List[str]):
+        self.outputs[column] = list(sources)
+        self.written.add(column)
+
+    def reads(self)->Set[str]:
+        """
+            Input columns read to produce the written columns or to filter rows
+        """
+        columns = set(self.required)
+        for column in self.written:
+            columns.update(self.outputs[column])
+        return columns
+
 class BasePreprocessor:
+    """
+        Preparation step, transforms the rows of a chunk
+
+        A preprocessor declares the columns it reads and writes (see lineage) and if it removes rows (filters_rows),
+        so the pipeline can skip it, fuse it with its neighbours or prune the columns it doesn't need.
+        Preprocessors not declaring their lineage are run as is, on all the columns.
+    """
+
+    # The preprocessor gives the same result whatever the dtype the columns it reads were loaded with
+    dtype_safe = False
+
+    # The preprocessor can remove rows
+    filters_rows = False
+
+    # Each row of the result only depends on the same row of the input, rows can be removed before the preprocessor
+    row_wise = False
 
     def apply(self, rows: pandas.DataFrame):
         pass
 
-class RenamePreprocessor(BasePreprocessor):
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        """
+            Lineage of the output columns, None if unknown (all columns are then considered as used)
+        """
+        return None
+
+    def reads(self, columns: List[str])->Optional[Set[str]]:
+        """
+            Columns read by the preprocessor, from the given columns (None if unknown)
+        """
+        lineage = self.lineage(columns)
+        return lineage.reads() if lineage is not None else None
+
+    def writes(self, columns: List[str])->Optional[Set[str]]:
+        """
+            Columns written by the preprocessor, from the given columns (None if unknown)
+        """
+        lineage = self.lineage(columns)
+        return set(lineage.written) if lineage is not None else None
+
+    def is_noop(self, columns: List[str])->bool:
+        """
+            The preprocessor changes nothing on data with the given columns
+        """
+        if self.filters_rows:
+            return False
+        lineage = self.lineage(columns)
+        return lineage is not None and len(lineage.written) == 0 and len(lineage.required) == 0
+
+    def fingerprint(self)->str:
+        """
+            Identify external data used by the preprocessor (config is already part of the profile fingerprint)
+        """
+        return ''
+
+class ColumnsPreprocessor(BasePreprocessor):
+    """
+        Preprocessor transforming each column independently from the others, columns can be transformed in parallel
+    """
+    def columns(self, data_columns: List[str])->List[Tuple[str, str]]:
+        """
+            List of (source column, target column) to transform
+        """
+        return []
+
+    def transform(self, data: pandas.Series)->pandas.Series:
+        return data
+
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage(columns)
+        for source, target, transforms in self.chains(columns):
+            lineage.write(target, [source])
+        return lineage
+
+    def chains(self, data_columns: List[str])->List[Tuple[str, str, List[Callable]]]:
+        """
+            List of (source column, target column, transforms to apply in sequence)
+        """
+        return [(source, target, [self.transform]) for source, target in self.columns(data_columns)]
+
+    def apply(self, rows: pandas.DataFrame, pool: Optional[Executor]=None):
+        """
+            pool: if provided, columns are transformed by the threads of the pool
+        """
+        tasks = self.chains(list(rows.columns))
+        if pool is None:
+            results = [(target, run_chain(rows[source], transforms)) for source, target, transforms in tasks]
+        else:
+            futures = [(target, pool.submit(run_chain, rows[source], transforms)) for source, target, transforms in tasks]
+            results = [(target, future.result()) for target, future in futures]
+        for target, data in results:
+            rows[target] = data
+        return rows
+
+def run_chain(data: pandas.Series, transforms: List[Callable])->pandas.Series:
+    for transform in transforms:
+        data = transform(data)
+    return data
+
+class FusedColumnsPreprocessor(ColumnsPreprocessor):
+    """
+        Consecutive column preprocessors applied in one pass: transforms of a column by several steps are chained
+        Steps must not read a column written (under another name) by a previous step of the group (see Pipeline)
+    """
+    def __init__(self, processors: List[ColumnsPreprocessor]):
+        self.processors = processors
+
+    def chains(self, data_columns: List[str])->List[Tuple[str, str, List[Callable]]]:
+        chains: Dict[str, Tuple[str, List[Callable]]] = {}
+        columns = list(data_columns)
+        for processor in self.processors:
+            for source, target in processor.columns(columns):
+                if source == target and target in chains:
+                    chains[target][1].append(processor.transform)
+                else:
+                    chains[target] = (source, [processor.transform])
+                if target not in columns:
+                    columns.append(target)
+        return [(source, target, transforms) for target, (source, transforms) in chains.items()]
+
+    def fingerprint(self)->str:
+        return ''.join(p.fingerprint() for p in self.processors)
+
+    def __str__(self) -> str:
+        return '+'.join(map(str, self.processors))
+
+class LabelsPreprocessor(BasePreprocessor):
+    """
+        Preprocessor only renaming columns, the new label of each column only depends on its current label
+        New labels are computed once by distinct header and the frame is relabelled in place
+    """
+    row_wise = True
+
+    def __init__(self):
+        self.plans: Dict[Tuple, List] = {}
+
+    def rename_label(self, label):
+        return label
+
+    def relabel(self, columns: Tuple)->List:
+        if columns not in self.plans:
+            self.plans[columns] = [self.rename_label(label) for label in columns]
+        return self.plans[columns]
+
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage([])
+        lineage.relabel = True
+        for column, label in zip(columns, self.relabel(tuple(columns))):
+            lineage.outputs.setdefault(label, []).append(column)
+            if label != column:
+                lineage.written.add(label)
+        return lineage
+
+    def apply(self, rows: pandas.DataFrame):
+        labels = self.relabel(tuple(rows.columns))
+        if labels != list(rows.columns):
+            rows.columns = labels
+        return rows
+
+class FusedLabelsPreprocessor(LabelsPreprocessor):
+    """
+        Several consecutive renaming preprocessors applied as one label transform
+    """
+    def __init__(self, processors: List[LabelsPreprocessor]):
+        super().__init__()
+        self.processors = processors
+
+    def rename_label(self, label):
+        for processor in self.processors:
+            label = processor.rename_label(label)
+        return label
+
+    def fingerprint(self)->str:
+        return ''.join(p.fingerprint() for p in self.processors)
+
+    def __str__(self) -> str:
+        return '+'.join(map(str, self.processors))
+
+class RenamePreprocessor(LabelsPreprocessor):
 
     def __init__(self, conf, global_conf) -> None:
+        super().__init__()
         if not isinstance(conf, dict):
             raise Exception("expected dict of rules 'pattern': 'replacement'")
         self.rules = conf
-        
-    def apply(self, rows: pandas.DataFrame):
-        for pattern, target in self.rules.items():
-            renamer = lambda n: re.sub(pattern, target, n)
-            rows.rename(columns=renamer, inplace=True)
-        return rows
+        self.compiled = [(re.compile(pattern), target) for pattern, target in conf.items()]
+
+    def rename_label(self, label):
+        for pattern, target in self.compiled:
+            label = pattern.sub(target, label)
+        return label
 
     def __str__(self) -> str:
         return '<rename>'
 
-class McgPreprocessor(BasePreprocessor):
+class McgPreprocessor(LabelsPreprocessor):
     """
         Rename columns with questionId + 'sep' + key   
     
     """
     def __init__(self, conf, global_conf):
+        super().__init__()
         
         if not 'key_separator' in global_conf:
             raise Exception("key_separator must be provided in _config entry (global config)")
@@ -53,16 +278,13 @@ class McgPreprocessor(BasePreprocessor):
             raise Exception("List of keys expected for mcg preprocessor")
 
         self.keys = conf
+        self.prefixes = [key + self.separator for key in conf]
 
-    def apply(self, rows: pandas.DataFrame):
-        for key in self.keys:
-            prefix = key + self.separator
-            def renamer(column:str):
-                if column is not None and column.startswith(prefix):
-                    return column.replace(self.separator, '_')
-                return column
-            rows.rename(columns=renamer, inplace=True)
-        return rows
+    def rename_label(self, label):
+        for prefix in self.prefixes:
+            if label is not None and label.startswith(prefix):
+                label = label.replace(self.separator, '_')
+        return label
 
     def __str__(self):
         return "<mcg(%s):%s>" % (self.separator, ','.join(self.keys))
@@ -74,7 +296,17 @@ def extract_items_keys(data):
             d.append(item['key'])
     return d
 
-class UnJsonPreprocessor(BasePreprocessor):
+class UnJsonPreprocessor(ColumnsPreprocessor):
+    """
+        Replace json values of columns by the values extracted by the parser
+        Each distinct json payload is parsed once, parsed values are memoized across columns and chunks
+    """
+
+    # Maximum number of memoized payloads
+    max_memo = 100000
+
+    row_wise = True
+
     def __init__(self, conf, global_conf):
         if not 'columns' in conf:
             raise Exception("expected 'columns' entry")
@@ -86,27 +318,37 @@ class UnJsonPreprocessor(BasePreprocessor):
             self.parser = extract_items_keys
         if self.parser is None:
             raise Exception("Unknown parser '%s'" % parser)
+        self.memo = {}
 
-    def apply(self, rows: pandas.DataFrame):
-
-        data_columns = list(rows.columns)
-
-        columns = self.columns_selector.select(data_columns)
-
-        def update_row(value):
-            if isna(value):
-                return value
-            v = json.loads(value)
-            v = self.parser(v)
-            if len(v) > 0:
-                v = ','.join(v)
+    def parse(self, value):
+        v = self.memo.get(value, None)
+        if v is not None:
             return v
-        
-        for column in columns:
-            if not column in rows.columns:
-                continue
-            rows[column] = rows[column].apply(update_row)
-        return rows
+        v = self.parser(json_loads(value))
+        if len(v) > 0:
+            v = ','.join(v)
+        if len(self.memo) >= self.max_memo:
+            self.memo = {}
+        self.memo[value] = v
+        return v
+
+    def transform(self, data: pandas.Series)->pandas.Series:
+        """
+            Parse each distinct value of the column once and spread the results, null values are kept as is
+        """
+        codes, uniques = pandas.factorize(data)
+        if len(uniques) == 0:
+            return data
+        parsed = numpy.empty(len(uniques), dtype=object)
+        for index, value in enumerate(uniques):
+            parsed[index] = self.parse(value) # Item by item, parsed values can be lists
+        values = data.to_numpy(dtype=object, copy=True)
+        found = codes >= 0
+        values[found] = parsed[codes[found]]
+        return pandas.Series(values, index=data.index, name=data.name)
+
+    def columns(self, data_columns: List[str])->List[Tuple[str, str]]:
+        return [(column, column) for column in self.columns_selector.select(data_columns)]
 
     def __str__(self):
         return "<unjson(%s):%s>" % (self.parser_name, self.columns_selector)
@@ -115,9 +357,16 @@ class TimeElapsedProcessor(BasePreprocessor):
     """
         Compute Time Elapsed column
     """
+    row_wise = True
+
     def __init__(self, conf, global_conf):
         pass
 
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage(columns)
+        lineage.write('timeelapsed', ['submitted', 'opened'])
+        return lineage
+
     def apply(self, rows: pandas.DataFrame):
         rows['timeelapsed'] = rows['submitted'] - rows['opened']
         return rows
@@ -125,10 +374,12 @@ class TimeElapsedProcessor(BasePreprocessor):
     def __str__(self):
         return "<timeelapsed>"
 
-class ToBooleanProcessor(BasePreprocessor):
+class ToBooleanProcessor(ColumnsPreprocessor):
     """
         Transform colum to boolean
     """
+    row_wise = True
+
     def __init__(self, conf, global_conf):
         if not 'columns' in conf:
             raise Exception("expected 'columns' entry")
@@ -137,78 +388,128 @@ class ToBooleanProcessor(BasePreprocessor):
         if 'na_false' in conf:
             self.na_false = bool(conf['na_false']) 
    
-    def apply(self, rows: pandas.DataFrame):
-        data_columns = list(rows.columns)
-        columns = self.columns_selector.select(data_columns)
-        booleans = {'0': False, '1':True, 'true': True, 'false': False}
-        if self.na_false:
-            to_bool = lambda x:str(x).lower() if not pandas.isna(x) else '0'
-        else:
-            to_bool = lambda x:str(x).lower() if not pandas.isna(x) else None
-        for column in columns:
-            rows[column] = rows[column].map(to_bool).replace(booleans)
-        return rows
+    def columns(self, data_columns: List[str])->List[Tuple[str, str]]:
+        return [(column, column) for column in self.columns_selector.select(data_columns)]
+
+    def transform(self, data: pandas.Series)->pandas.Series:
+        return to_boolean(data, self.na_false)
 
     def __str__(self):
         return "<boolean:%s>" % (self.columns_selector)
 
-class IndicatorProcessor(BasePreprocessor):
+class IndicatorProcessor(ColumnsPreprocessor):
     """
        Create a boolean variable (indicator) if another has non empty data
        
        parameters : dictionary with a set of rules (like rename) key = column where data are, value = pattern to create indicator columns
 
     """
+
+    dtype_safe = True
+
+    row_wise = True
+
     def __init__(self, conf, global_conf):
         if not isinstance(conf, dict):
             raise Exception("parameters must be a dictionary")
         self.rules = conf
-
-    def apply(self, rows: pandas.DataFrame):
-        data_columns = list(rows.columns)
-
-        for source_pattern, target_pattern in self.rules.items():
+        self.compiled = [(re.compile(pattern), target) for pattern, target in conf.items()]
+
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage(columns)
+        for source_pattern, target_pattern in self.compiled:
+            for column in columns:
+                if source_pattern.match(column) is not None:
+                    target_column = source_pattern.sub(target_pattern, column)
+                    if target_column in columns:
+                        lineage.required.add(target_column) # Keep it so the conflict is reported
+                    lineage.write(target_column, [column])
+        return lineage
+
+    def columns(self, data_columns: List[str])->List[Tuple[str, str]]:
+        tasks = []
+        for source_pattern, target_pattern in self.compiled:
             for column in data_columns:
-                if re.match(source_pattern, column) is not None:
-                    target_column = re.sub(source_pattern, target_pattern, column)
+                if source_pattern.match(column) is not None:
+                    target_column = source_pattern.sub(target_pattern, column)
                     if target_column in data_columns:
                         raise Exception("Column '%s' already in the data, cannot use it for indicator (from %s)" % (target_column, column))
-                    rows[target_column] = rows[column].map(lambda x: True if not isna(x) else False)
-        return rows
+                    tasks.append((column, target_column))
+        return tasks
+
+    def transform(self, data: pandas.Series)->pandas.Series:
+        return data.notna()
 
     def __str__(self):
         return "<indicator:%s>" % (str(self.rules))
 
 class MigrationProcessor(BasePreprocessor):
     """
-        Replace
+        Replace global_id by its migrated value (from migrations.json), optionally reencode the other ones (see encode_global_id)
+        Only distinct global_id are migrated, resolved values are memoized across chunks
     """
+
+    # Maximum number of memoized ids
+    max_memo = 1000000
+
+    dtype_safe = True
+
+    row_wise = True
+
     def __init__(self, conf, global_conf):
         self.load(global_conf)
         self.encode = 'encode' in conf and conf['encode']
+        self.memo = {}
     
     def load(self, global_conf):
         if not 'migrations' in global_conf:
             raise Exception("migrations is not available in global config")
         conf = global_conf['migrations']
-        data = None
-        if 'file' in conf:
-            path = global_conf['path']
-            f = path + '/' + conf['file']
-            data = json.load(open(f, 'r'))
-        if data is None:
+        if not 'file' in conf:
             raise Exception("Unable to load migrations")
-        self.migrations = data
+        path = global_conf['path']
+        f = path + '/' + conf['file']
+        if not os.path.exists(f):
+            raise Exception("Unable to load migrations, file '%s' not found" % f)
+        self.file = f
+        self.index = MigrationIndex(f)
+
+    def fingerprint(self)->str:
+        st = os.stat(self.file)
+        return "%s:%d:%d" % (self.file, st.st_size, st.st_mtime_ns)
+
+    def resolve(self, ids: list)->list:
+        """
+            Migrated values of distinct ids
+        """
+        unknown = [v for v in ids if v not in self.memo]
+        if len(unknown) > 0:
+            if len(self.memo) + len(unknown) > self.max_memo:
+                self.memo = {}
+            migrations = self.index.lookup(unknown)
+            for value in unknown:
+                if value in migrations:
+                    self.memo[value] = migrations[value]
+                elif self.encode:
+                    self.memo[value] = str(encode_global_id(value))
+                else:
+                    self.memo[value] = value
+        return [self.memo[v] for v in ids]
     
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage(columns)
+        lineage.write('global_id', ['global_id'])
+        return lineage
+
     def apply(self, rows: pandas.DataFrame):
-        def migrate_id(value):
-            if value in self.migrations:
-                return self.migrations[value]
-            if self.encode:
-                return str(encode_global_id(value))
-            return value
-                
-        rows['global_id'] = rows['global_id'].apply(migrate_id)
+        data = rows['global_id']
+        codes, uniques = pandas.factorize(data)
+        migrated = numpy.empty(len(uniques), dtype=object)
+        migrated[:] = self.resolve(uniques.tolist())
+        values = data.to_numpy(dtype=object, copy=True)
+        found = codes >= 0
+        values[found] = migrated[codes[found]]
+        rows['global_id'] = pandas.Series(values, index=data.index, name=data.name)
         return rows
 
     def __str__(self):
@@ -216,27 +517,74 @@ class MigrationProcessor(BasePreprocessor):
 
 class SkipIfNullProcessor(BasePreprocessor):
     """
-       Create a boolean variable (indicator) if another has non empty data
-       
-       parameters : dictionary with a set of rules (like rename) key = column where data are, value = pattern to create indicator columns
+       Remove rows having a null value in one of the selected columns
+
+       parameters : columns = column selector of the columns which must not be null
 
+       When the selected columns are only renamed by the previous steps, the filter is moved before them (see Pipeline)
     """
+    dtype_safe = True
+
+    filters_rows = True
+
+    row_wise = True
+
     def __init__(self, conf, global_conf):
         self.columns_selector = ColumnSelector(conf['columns'])
-        
+
+    def keys(self, columns: List[str])->List[str]:
+        """
+            Columns which must not be null, from the given columns
+        """
+        return self.columns_selector.select(columns)
+
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage(columns)
+        lineage.required.update(self.keys(columns))
+        return lineage
+
     def apply(self, rows: pandas.DataFrame):
-       data_columns = list(rows.columns)
-       columns = self.columns_selector.select(data_columns)
-       to_skip = pandas.isnull(rows[columns]).any(axis='columns') 
-       if to_skip.any():
-            df_null = rows[to_skip]
-            print(df_null[['ID','global_id']])
-            rows = rows[ ~ to_skip ]
-       return rows
-       
+        return skip_null_keys(rows, self.keys(list(rows.columns)))
+
     def __str__(self):
         return "<skip_if_null:%s>" % (str(self.columns_selector))
 
+def skip_null_keys(rows: pandas.DataFrame, keys: List[str])->pandas.DataFrame:
+    """
+        Rows without null value in the key columns
+    """
+    if len(keys) == 0:
+        return rows
+    to_skip = rows[keys].isna().any(axis='columns')
+    if to_skip.any():
+        rows = rows.drop(index=rows.index[to_skip])
+    return rows
+
+class NullKeysFilter(BasePreprocessor):
+    """
+        skip_if_null step moved before the steps renaming its columns, keys are the names of the columns at this point
+    """
+    dtype_safe = True
+
+    filters_rows = True
+
+    row_wise = True
+
+    def __init__(self, processor: SkipIfNullProcessor, keys: List[str]):
+        self.processor = processor
+        self.keys = keys
+
+    def lineage(self, columns: List[str])->Optional[Lineage]:
+        lineage = Lineage(columns)
+        lineage.required.update(self.keys)
+        return lineage
+
+    def apply(self, rows: pandas.DataFrame):
+        return skip_null_keys(rows, self.keys)
+
+    def __str__(self):
+        return "<skip_if_null:%s>" % ','.join(self.keys)
+
 PREPROCESSORS = {
     'rename': RenamePreprocessor,
     'unjson': UnJsonPreprocessor,
@@ -247,3 +595,45 @@ PREPROCESSORS = {
     'indicator':IndicatorProcessor,
     'skip_if_null': SkipIfNullProcessor,
 }
+
+# Entry point group of preprocessors provided by other packages
+ENTRY_POINT_GROUP = 'ifndb.preprocessors'
+
+_entry_points_loaded = False
+
+def register_preprocessor(name: str, klass):
+    """
+        Register a preprocessor class, usable in profiles by its name
+    """
+    PREPROCESSORS[name] = klass
+
+def load_entry_points():
+    """
+        Register preprocessors declared by installed packages in the 'ifndb.preprocessors' entry point group
+        Built-in preprocessors cannot be replaced
+    """
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    from importlib.metadata import entry_points
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        group = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        group = eps.get(ENTRY_POINT_GROUP, [])
+    for ep in group:
+        if ep.name in PREPROCESSORS:
+            continue
+        try:
+            register_preprocessor(ep.name, ep.load())
+        except Exception as e:
+            print("[warning] Unable to load preprocessor '%s' (%s): %s" % (ep.name, ep.value, e))
+
+def get_preprocessor(name: str):
+    """
+        Class of the preprocessor registered with the name, None if unknown
+    """
+    if name not in PREPROCESSORS:
+        load_entry_points()
+    return PREPROCESSORS.get(name)
@@ -1,12 +1,16 @@
 import fnmatch
-from typing import Dict, Optional, List
+import hashlib
+import json
+import re
+from typing import Dict, Optional, List, Tuple
 from collections import OrderedDict
 from ..common import get_table_name
 from ..utils import read_yaml
 from .types import CONVERTS
 import numpy
 
-from . preprocess import PREPROCESSORS
+from . preprocess import get_preprocessor
+from .pipeline import Pipeline
 
 class ColumnConf:
     """
@@ -34,6 +38,47 @@ class ColumnConf:
                     self.to = conf['to']
         if self.to is not None and not self.to in CONVERTS:
             raise Exception("Unknown conversion type '%s' for '%s'" % (self.to, name))
+class MappingResolver:
+    """
+        Resolve the mapping entry of a column
+
+        Exact names are looked up first, then patterns are tried in the order of the profile,
+        all patterns are compiled into a single regex. Results are memoized by column name.
+    """
+    def __init__(self, mapping: Dict[str, ColumnConf], patterns: List[str]):
+        self.mapping = mapping
+        self.patterns = patterns
+        self.regex = None
+        if len(patterns) > 0:
+            alternatives = ["(?P<_p%d>%s)" % (index, fnmatch.translate(p)) for index, p in enumerate(patterns)]
+            self.regex = re.compile("|".join(alternatives))
+        self.resolved: Dict[str, Optional[ColumnConf]] = {}
+        self.plans: Dict[Tuple[str], Dict[str, Optional[ColumnConf]]] = {}
+
+    def get(self, name: str)->Optional[ColumnConf]:
+        if name in self.resolved:
+            return self.resolved[name]
+        conf = self.mapping.get(name, None)
+        if conf is None and self.regex is not None:
+            m = self.regex.match(name)
+            if m is not None:
+                for index, pattern in enumerate(self.patterns):
+                    if m.group('_p%d' % index) is not None:
+                        conf = self.mapping[pattern]
+                        break
+        self.resolved[name] = conf
+        return conf
+
+    def resolve(self, columns: List[str])->Dict[str, Optional[ColumnConf]]:
+        """
+            Resolved mapping for a list of columns (column -> ColumnConf or None if not in mapping)
+            The plan is built once for a given list of columns
+        """
+        key = tuple(columns)
+        if key not in self.plans:
+            self.plans[key] = OrderedDict((name, self.get(name)) for name in columns)
+        return self.plans[key]
+
 class TableConf:
     """
         Describe mapping for a table
@@ -48,6 +93,8 @@ class TableConf:
         self.csv_types = None
         self.table = conf['table']
         self.preprocess = []
+        self.conf = conf
+        self.global_conf = global_conf
         
         if 'csv_types' in conf:
             # dtypes can be used to force type during csv loading
@@ -68,14 +115,14 @@ class TableConf:
                 except Exception as e:
                     raise Exception("Error in prepare %d : %s" % (index, e)) from e
 
-    def get_mapping(self, name):
-        if name in self.mapping:
-            return self.mapping[name]
-        if len(self.patterns) > 0:
-            for pattern in self.patterns:
-                if fnmatch.fnmatch(name, pattern):
-                    return self.mapping[pattern]
-        return None
+        self.resolver = MappingResolver(self.mapping, self.patterns)
+        self.pipeline = Pipeline(self.preprocess)
+
+    def get_mapping(self, name)->Optional[ColumnConf]:
+        return self.resolver.get(name)
+
+    def resolve_mapping(self, columns: List[str])->Dict[str, Optional[ColumnConf]]:
+        return self.resolver.resolve(columns)
 
     def create_dtypes(self, conf:Dict):
         o = {}
@@ -102,15 +149,27 @@ class TableConf:
 
     def create_preprocessor(self, conf, global_conf):
         if not isinstance(conf, dict):
-            raise("Preproressor entry must be a dict")
+            raise Exception("Preproressor entry must be a dict")
         for name, params in conf.items():
-            if not name in PREPROCESSORS:
+            klass = get_preprocessor(name)
+            if klass is None:
                 raise Exception("Unknown preprocessor '%s'" % name)
-            klass = PREPROCESSORS[name]
             return klass(params, global_conf)
 
     def get_table_name(self)->str:
         return get_table_name(self.table)
+
+    def fingerprint(self)->str:
+        """
+            Hash of the table configuration (and of the external data used by preprocessors)
+        """
+        globals = dict((k, v) for k, v in self.global_conf.items() if k not in ['debug', 'path'])
+        data = {
+            'conf': self.conf,
+            'globals': globals,
+            'preprocess': [p.fingerprint() for p in self.preprocess],
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
         
 
 class Profile:
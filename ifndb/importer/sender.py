@@ -0,0 +1,84 @@
+"""
+    Sending of encoded rows by a dedicated thread
+
+    Rows are encoded while the previous ones are sent: encoded rows wait in a bounded queue (encoding waits when the queue is full),
+    so the database ingests rows while the next ones are encoded. The sending thread uses the session of the thread loading the rows,
+    which does not use the database until the sender is closed.
+"""
+import queue
+import threading
+from typing import Optional
+
+from ..db import connection
+from ..profiling import StageProfiler
+
+# End of the rows to send
+_STOP = object()
+
+class BatchSender:
+    """
+        Send encoded rows to a batch (DbCopy, DbBatch...) from a thread
+        size: maximum number of encoded parts waiting to be sent
+    """
+    def __init__(self, batch, profiler: StageProfiler, size: int):
+        self.batch = batch
+        self.profiler = profiler
+        self.queue = queue.Queue(maxsize=size)
+        self.error: Optional[BaseException] = None
+        self.aborted = False
+        self.session = connection.session
+        self.thread = threading.Thread(target=self.run, name='ifndb-send', daemon=True)
+        self.thread.start()
+
+    def put(self, payloads: list, rows: int):
+        """
+            Queue encoded rows, waits if the queue is full
+            Raises the error of the sender if sending previous rows failed
+        """
+        self.check()
+        self.queue.put((payloads, rows))
+
+    def run(self):
+        with connection.attach(self.session):
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    return
+                if self.error is not None or self.aborted:
+                    continue # Remaining rows are dropped
+                payloads, rows = item
+                try:
+                    self.send(payloads, rows)
+                except BaseException as e:
+                    self.error = e
+
+    def send(self, payloads: list, rows: int):
+        with self.profiler.stage('send', rows) as run:
+            sent = self.batch.sent
+            self.batch.extend(payloads)
+            run.bytes_sent = self.batch.sent - sent
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+            Wait until all queued rows are sent
+        """
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.check()
+
+    def abort(self):
+        """
+            Drop queued rows and wait for the end of the sending in progress
+        """
+        self.aborted = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put(_STOP)
+        self.thread.join()
@@ -1,6 +1,7 @@
-from typing import Tuple
+from typing import Iterator, List, Optional
 from datetime import datetime
 import pandas
+from pandas.api.types import is_numeric_dtype
 DATASOURCE_CSV = 'csv'
 
 class DataSource:
@@ -8,6 +9,7 @@ class DataSource:
         self.source_type = source_type
         self.min_time : datetime = None
         self.max_time : datetime = None
+        self.time_column : Optional[str] = None
 
     def set_time_range(self, min_time: datetime, max_time:datetime):
         self.min_time = min_time
@@ -19,20 +21,64 @@ class DataSource:
     def has_time_range(self):
         return self.min_time is not None
 
+    def time_mask(self, rows: pandas.DataFrame)->Optional[pandas.Series]:
+        """
+            Rows inside the time range (rows without time are kept), None if rows cannot be filtered on time
+        """
+        if not self.has_time_range() or self.time_column is None or self.time_column not in rows.columns:
+            return None
+        times = to_times(rows[self.time_column])
+        return times.isna() | ((times >= self.min_time) & (times <= self.max_time))
+
     def is_csv(self):
         return self.source_type == DATASOURCE_CSV
 
-    def load(self, dtype=None)->pandas.DataFrame:
+    def header(self)->Optional[List[str]]:
+        """
+            Columns of the data if they can be known without loading the data, None otherwise
+        """
+        return None
+
+    def load(self, dtype=None, usecols=None)->pandas.DataFrame:
         pass
 
+    def iter_chunks(self, dtype=None, chunk_size:int=0, usecols=None)->Iterator[pandas.DataFrame]:
+        """
+            Iterate over the data by chunks of chunk_size rows
+            usecols: only load these columns (None = all columns)
+            Default implementation yields the whole data in one chunk
+        """
+        yield self.load(dtype=dtype, usecols=usecols)
+
 class CSVDataSource(DataSource):
 
     def __init__(self, csv_file: str, time_column:str):
         super().__init__(DATASOURCE_CSV)
         self.csv_file = csv_file
+        self.time_column = time_column
+
+    def header(self)->Optional[List[str]]:
+        return list(pandas.read_csv(self.csv_file, nrows=0).columns)
 
-    def load(self, dtype=None)->pandas.DataFrame:
-        rows = pandas.read_csv(self.csv_file, dtype=dtype)
+    def load(self, dtype=None, usecols=None)->pandas.DataFrame:
+        rows = pandas.read_csv(self.csv_file, dtype=dtype, usecols=usecols)
         return rows
 
+    def iter_chunks(self, dtype=None, chunk_size:int=0, usecols=None)->Iterator[pandas.DataFrame]:
+        if chunk_size is None or chunk_size <= 0:
+            yield self.load(dtype=dtype, usecols=usecols)
+            return
+        with pandas.read_csv(self.csv_file, dtype=dtype, chunksize=chunk_size, usecols=usecols) as reader:
+            yield from reader
 
+def to_times(data: pandas.Series)->pandas.Series:
+    """
+        Times of a column of timestamps (seconds since epoch) or of textual dates, as naive UTC times
+    """
+    if not is_numeric_dtype(data):
+        numbers = pandas.to_numeric(data, errors='coerce')
+        if numbers.notna().sum() == data.notna().sum():
+            data = numbers
+    if is_numeric_dtype(data):
+        return pandas.to_datetime(data, unit='s', errors='coerce')
+    return pandas.to_datetime(data, errors='coerce', utc=True).dt.tz_localize(None)
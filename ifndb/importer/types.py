@@ -1,11 +1,43 @@
+from typing import Optional
+
+from ..db.types import normalize_db_type
+
 CONVERTS = ['int','bool','date','timestamp','str','month-year']
 
+INT_DTYPES = ['int','int32','int8','int64', 'float64','int16', 'Int8', 'Int16', 'Int32', 'Int64']
+
 # Database type
 TYPE_COMPAT = {
-    'int':['int','int32','int8','int64', 'float64','int16'],
+    'int': INT_DTYPES,
+    'smallint': INT_DTYPES,
+    'bigint': INT_DTYPES,
     'text': ['str', 'object'],
     'varying': ['str', 'object'],
     'bool': ['bool', 'boolean'],
     'date': ['date', 'datetime64[ns]'],
     'timestamp with time zone': ['datetime64[ns]']
 }
+
+# Nullable dtype used to hold the values of an integer column, by database type
+INT_READ_DTYPES = {
+    'smallint': 'Int16',
+    'int': 'Int32',
+    'bigint': 'Int64',
+}
+
+def auto_convert_type(dbtype: str)->Optional[str]:
+    """
+        Default conversion of a column imported in a column of the given database type
+    """
+    dbtype = normalize_db_type(dbtype)
+    if dbtype in INT_READ_DTYPES:
+        return 'int'
+    if dbtype == 'timestamp with time zone':
+        return 'timestamp'
+    if dbtype == 'date':
+        return 'date'
+    if dbtype == 'bool':
+        return 'bool'
+    if dbtype == 'text' or dbtype == 'varying':
+        return 'str'
+    return None
@@ -0,0 +1,204 @@
+"""
+    Per-stage timing instrumentation
+
+    A stage is a named step of a pipeline (reading a chunk, a preprocessor, encoding...), each time a stage is run
+    the wall and cpu time, rows in/out and bytes sent are accumulated.
+    Stages can run in several threads, cpu time is the time of the thread running the stage.
+"""
+import cProfile
+import json
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from rich.console import Console
+from rich.table import Table
+
+def peak_rss()->int:
+    """
+        Peak resident memory of the process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class StageStat:
+    """
+        Accumulated measures of a stage
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_sent = 0
+        self.peak_rss = 0
+
+    def add(self, other: 'StageStat'):
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.rows_in += other.rows_in
+        self.rows_out += other.rows_out
+        self.bytes_sent += other.bytes_sent
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+    def to_dict(self)->Dict:
+        return {
+            'stage': self.name,
+            'calls': self.calls,
+            'wall': round(self.wall, 6),
+            'cpu': round(self.cpu, 6),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_sent': self.bytes_sent,
+            'peak_rss': self.peak_rss,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict)->'StageStat':
+        stat = StageStat(data['stage'])
+        for name in ['calls', 'wall', 'cpu', 'rows_in', 'rows_out', 'bytes_sent', 'peak_rss']:
+            setattr(stat, name, data[name])
+        return stat
+
+class StageRun:
+    """
+        Measures of one run of a stage, rows_out and bytes_sent can be set by the instrumented code
+    """
+    def __init__(self, rows_in: int):
+        self.rows_in = rows_in
+        self.rows_out = rows_in
+        self.bytes_sent = 0
+
+class StageProfiler:
+    """
+        Collect measures of stages
+        output: path of a file where stages measures are appended as json lines (one line by stage for each report)
+        dump_stage: name of a stage to run under cProfile, stats are written in [dump_stage].prof
+    """
+    def __init__(self, output: Optional[str]=None, dump_stage: Optional[str]=None):
+        self.output = output
+        self.dump_stage = dump_stage
+        self.cprofile = None
+        if dump_stage is not None:
+            self.cprofile = cProfile.Profile()
+        self.stats: Dict[str, StageStat] = OrderedDict()
+        self.lock = threading.Lock()
+        self.profiling = None # Thread running the cProfile of dump_stage
+
+    def is_enabled(self)->bool:
+        return True
+
+    def get(self, name: str)->StageStat:
+        if name not in self.stats:
+            self.stats[name] = StageStat(name)
+        return self.stats[name]
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int=0):
+        run = StageRun(rows_in)
+        profile = False
+        if self.cprofile is not None and name.startswith(self.dump_stage):
+            # Only one thread (and one stage of nested ones) runs under the profiler at a time
+            with self.lock:
+                if self.profiling is None:
+                    self.profiling = threading.get_ident()
+                    profile = True
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        if profile:
+            self.cprofile.enable()
+        try:
+            yield run
+        finally:
+            if profile:
+                self.cprofile.disable()
+                self.profiling = None
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            rss = peak_rss()
+            with self.lock:
+                stat = self.get(name)
+                stat.calls += 1
+                stat.wall += wall
+                stat.cpu += cpu
+                stat.rows_in += run.rows_in
+                stat.rows_out += run.rows_out
+                stat.bytes_sent += run.bytes_sent
+                stat.peak_rss = max(stat.peak_rss, rss)
+
+    def iterate(self, name: str, chunks: Iterator)->Iterator:
+        """
+            Measure the time spent to produce each chunk of an iterator
+        """
+        while True:
+            with self.stage(name) as run:
+                chunk = next(chunks, None)
+                run.rows_out = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                return
+            yield chunk
+
+    def collect(self)->List[Dict]:
+        """
+            Returns the measures and reset them
+        """
+        with self.lock:
+            data = [stat.to_dict() for stat in self.stats.values()]
+            self.stats = OrderedDict()
+        return data
+
+    def merge(self, data: List[Dict]):
+        """
+            Add measures collected by another profiler (from a worker process)
+        """
+        with self.lock:
+            for d in data:
+                self.get(d['stage']).add(StageStat.from_dict(d))
+
+    def report(self, label: str):
+        """
+            Show the summary of stages measured since the last report
+        """
+        with self.lock:
+            stats = list(self.stats.values())
+        table = Table(title="Stages: %s" % label)
+        table.add_column('Stage', no_wrap=True)
+        for column in ['Calls', 'Wall (s)', 'CPU (s)', 'Rows in', 'Rows out', 'Sent (KB)', 'Peak RSS (MB)']:
+            table.add_column(column)
+        for stat in stats:
+            table.add_row(stat.name, str(stat.calls), "%.3f" % stat.wall, "%.3f" % stat.cpu, str(stat.rows_in), str(stat.rows_out), "%.1f" % (stat.bytes_sent / 1024), "%.1f" % (stat.peak_rss / (1024 * 1024)))
+        Console().print(table)
+        data = self.collect()
+        if self.output is not None:
+            with open(self.output, 'a') as f:
+                for d in data:
+                    d['label'] = label
+                    d['time'] = time.time()
+                    f.write(json.dumps(d) + "\n")
+        if self.cprofile is not None:
+            self.cprofile.dump_stats("%s.prof" % self.dump_stage.replace(' ', '_').replace('/', '_'))
+
+class NullProfiler(StageProfiler):
+    """
+        Profiler doing nothing (when stage profiling is not enabled)
+    """
+    def __init__(self):
+        super().__init__()
+
+    def is_enabled(self)->bool:
+        return False
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int=0):
+        yield StageRun(rows_in)
+
+    def iterate(self, name: str, chunks: Iterator)->Iterator:
+        return chunks
+
+    def report(self, label: str):
+        pass